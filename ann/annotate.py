@@ -12,8 +12,18 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import file_utils as fu
 import utils as u
+import intervals
+import queries as q
+import transcripts
+import sites
+import bloom
+import refschema
+import vcfrecord
+import vcfbatch
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
+CPG_COLUMNS = ['chrom', 'chromStart', 'chromEnd', 'name']
+TFBS_COLUMNS = ['chrom', 'chromStart', 'chromEnd', 'name']
 
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
@@ -93,6 +103,18 @@ def getFormatSpecificIndices(format='vcf'):
     return [chr_ind, pos_ind, ref_ind, alt_ind]
 
 
+"""Chromosome with the 'chr' prefix, as most reference tables name it
+"""
+def withChr(chr):
+    return chr if chr.startswith('chr') else 'chr' + chr
+
+
+"""Chromosome without the 'chr' prefix (gadAll, dbSNP)
+"""
+def withoutChr(chr):
+    return chr.replace('chr', '') if chr.startswith('chr') else chr
+
+
 def getComplementary(nuc):
     compNuc = ''
     if (str(nuc) == 'A'):
@@ -107,29 +129,201 @@ def getComplementary(nuc):
         return compNuc
 
 
+"""Prints a summary line of a stage and adds it to the stage's .count.log
+   lines. For a QuietLog the line is only added, and marked for whoever
+   merges the log to print.
+"""
+def summary(log, text):
+    if isinstance(log, QuietLog):
+        log.printed.append(len(log))
+    else:
+        print(text)
+    log.append(text + '\n')
+
+
+class QuietLog(list):
+    """.count.log lines of one of several runs of a stage whose logs are
+    merged (see driver.concurrentStage): summary lines are not printed by
+    the run, their indices are kept in printed instead
+    """
+    def __init__(self):
+        super().__init__()
+        self.printed = []
+
+
+"""Runs one record stage as a separate pass over the intermediate file
+   vcf + tmpextin, writing vcf + tmpextout and the stage's counters to
+   vcf + '.count.log'.
+   A stage is a generator taking an iterable of VCF lines and a list that
+   collects its .count.log lines; it yields one output line per input line,
+   so stages can also be chained in memory (see driver.run). Data lines
+   are yielded as vcfrecord.Records, which later stages take as they are;
+   a record is serialized only when it is written.
+"""
+def runStage(stage, vcf, tmpextin, tmpextout, logmode='a', **kwargs):
+    fh = fu.openText(vcf + tmpextin)
+    fh_out = open(vcf + tmpextout, "w")
+    log = []
+
+    for line in stage(fh, log, **kwargs):
+        fh_out.write(str(line) + '\n')
+
+    if (len(log) > 0 or logmode == 'w'):
+        fh_log = open(vcf + '.count.log', logmode)
+        fh_log.writelines(log)
+        fh_log.close()
+
+    fh.close()
+    fh_out.close()
+
+
+"""Rows of a region table containing chr:pos. Uses the in-memory interval
+   index when one is given (see intervals.py), otherwise runs the range
+   query stmt (see queries.py) with params. With one=True returns the
+   first row or None, like fetchone.
+   For an index, offset widens the intervals on both sides, match
+   applies the non-positional conditions of stmt to each row and select
+   projects rows onto the named columns of the stmt's select list.
+   Results are memoized per site (see sites.py) and must not be modified.
+"""
+def fetchRegion(cursor, stmt, params, index, chr, pos, one=False, offset=0, 
+    match=None, select=None):
+    return sites.lookup(stmt.name, (str(chr), str(pos), params, one), 
+        lambda: queryRegion(cursor, stmt, params, index, chr, pos, one=one, 
+        offset=offset, match=match, select=select))
+
+
+"""fetchRegion without the per-site cache
+"""
+def queryRegion(cursor, stmt, params, index, chr, pos, one=False, offset=0, 
+    match=None, select=None):
+    if (index is not None):
+        rows = index.overlap(chr, int(pos) - offset, int(pos) + offset)
+        if (match is not None):
+            rows = [row for row in rows if match(row)]
+        if (select is not None):
+            cols = [index.columns.index(c) for c in select]
+            rows = [tuple([row[c] for c in cols]) for row in rows]
+        if one:
+            return rows[0] if (len(rows) > 0) else None
+        return rows
+
+    return stmt.run(cursor, params, one=one)
+
+
+"""Rows of index containing the position of each record of a batch (see
+   vcfbatch.py), looked up a chromosome at a time with the index's
+   vectorized stabMany; chrom maps a VCF chromosome to the table's naming.
+   None for every record when there is no index or it has no batch
+   lookup (a SweepIndex), so that fetchRegion is used instead.
+"""
+def stabBatch(index, batch, chrom, select=None):
+    found = [None] * len(batch)
+    if (index is None or not hasattr(index, 'stabMany')):
+        return found
+    for name, members in batch.groups():
+        stabGroup(index, batch, members, chrom(name), found, select)
+    return found
+
+
+"""Sets found[i] to the rows of index containing the position of record i
+   of a batch, for the members of one chromosome; select projects rows
+   as in queryRegion
+"""
+def stabGroup(index, batch, members, chrom, found, select=None):
+    cols = None
+    if (select is not None):
+        cols = [index.columns.index(c) for c in select]
+    for i, rows in zip(members, 
+        index.stabMany(chrom, batch.positions[members])):
+        if (cols is not None):
+            rows = [tuple([row[c] for c in cols]) for row in rows]
+        found[i] = rows
+
+
+"""Statement for the rows of a region table containing a position, bound
+   as (chr, pos, pos); with chrom=None as (pos, pos). Tables migrated by
+   refschema.py are restricted to the bins that can hold the position.
+"""
+def regionStatement(table, columns='*', chrom='chrom', start='chromStart',
+    end='chromEnd'):
+    where = ''
+    if (chrom is not None):
+        where = chrom + '=%s AND '
+    if refschema.binned(table, start, end):
+        return q.register(table + ' ' + start + '-' + end + ' bin', 
+            'select ' + columns + ' from ' + table + ' where ' + where + \
+            'bin IN %s AND (' + start + ' <= %s AND %s <= ' + end + ');',
+            bind=lambda p: p[:-2] + (refschema.overlappingBins(
+                int(p[-2]) - 1, int(p[-1])),) + p[-2:])
+    return q.register(table + ' ' + start + '-' + end, 'select ' + columns + \
+        ' from ' + table + ' where ' + where + '(' + start + ' <= %s AND ' + \
+        '%s <= ' + end + ');')
+
+
+"""Statement for the transcripts of a gene table whose span, widened by
+   the promoter offset, contains a position; bound as
+   (chr, offset, pos, pos, offset). Tables migrated by refschema.py with
+   the same offset are read through their promoter bounds and bins.
+"""
+def geneStatement(table, offset=500):
+    if refschema.promoterBinned(table, offset):
+        return q.register(table + ' promoter bin', 'select * from ' + table + \
+            ' where chrom=%s AND promoterBin IN %s AND promoterStart <= %s ' + \
+            'AND %s <= promoterEnd;', 
+            bind=lambda p: (p[0], refschema.overlappingBins(int(p[2]) - 1, 
+                int(p[3])), p[2], p[3]))
+    return q.register(table + ' promoter', 'select * from ' + table + \
+        ' where chrom=%s AND (txStart - %s) <= %s AND %s <= (txEnd + %s);')
+
+
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    With batch_size > 1 up to batch_size records are buffered and resolved
+    with one dbSNP query per chromosome (see fetchDbSnpBatch).
+    With use_index dbSNP is read from intervals.load instead of the database.
+    With use_filter sites ruled out by the filter in use (see
+    bloom.useFilter) are written without a lookup.
 """ 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
+def getSnpsFromDbSnpStage(lines, log, format='vcf', varclass='SNV', sep='\t',
+    batch_size=1, use_index=False, use_filter=False):
     var_count = 0
 
     inds = getFormatSpecificIndices(format=format)
+    bloomFilter = bloom.active() if use_filter else None
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    if use_index:
+        index = intervals.load('dbSNP', 'CHR', 'POS', 'POS')
+    else:
+        conn = u.db_connect()
+        cursor = conn.cursor()
     linenum = 1
+    records = []
+
+    def fetch(keys):
+        if use_index:
+            return [fetchDbSnpIndexed(index, key, varclass) for key in keys]
+        elif (len(keys) == 1):
+            return [fetchDbSnp(cursor, keys[0], varclass)]
+        return fetchDbSnpBatch(cursor, keys, varclass)
+
+    def flush():
+        nonlocal var_count
+        found = iter(sites.lookupMany('dbSNP ' + varclass, 
+            [key for rec, key in records if key is not None], fetch))
+
+        for rec, key in records:
+            # Sites ruled out by the filter are kept in order with no key
+            rows = [] if (key is None) else next(found)
+            if (len(rows) > 0):
+                var_count = var_count + 1
+            yield addDbSnpRows(rec, rows, varclass)
+        del records[:]
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
+    for line in lines:
+        rec = vcfrecord.parse(line, sep)
+        if rec is not None:
+            fields = rec.fields
             chr = fields[inds[0]].strip()
             if chr.startswith("chr"):
                 chr = chr.replace('chr', '')
@@ -141,78 +335,183 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
             compRef = getComplementary(ref)
             compAlt = getComplementary(alt)
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            if (bloomFilter is not None and
+                not bloomFilter.mayContain(chr, pos, ref) and
+                not bloomFilter.mayContain(chr, pos, compRef)):
+                if (len(records) == 0):
+                    yield addDbSnpRows(rec, [], varclass)
+                else:
+                    records.append((rec, None))
+                linenum = linenum + 1
+                continue
+
+            records.append((rec, (chr, pos, ref, compRef)))
+            if (len(records) >= batch_size):
+                yield from flush()
 
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+            linenum = linenum + 1
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+        else:
+            if (len(records) > 0):
+                yield from flush()
+            yield line.strip()
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+    if (len(records) > 0):
+        yield from flush()
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    ratioInDbSnp = (var_count / float(linenum)) * 100
+    log.append("## Please notice that all Isoforms were counted\n")
+    log.append("## Numbers may exceed number of variants in the annotated file\n")
+    log.append(f"Total: {str(linenum)}\n")
+    log.append(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+    if not use_index:
+        conn.close()
+
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=1, use_index=False,
+    use_filter=False):
+    runStage(getSnpsFromDbSnpStage, vcf, tmpextin, tmpextout, logmode='w',
+        format=format, varclass=varclass, sep=sep, batch_size=batch_size,
+        use_index=use_index, use_filter=use_filter)
 
-            linenum = linenum + 1
 
+"""dbSNP rows for one (chr, pos, ref, compRef) key
+"""
+def fetchDbSnp(cursor, key, varclass='SNV'):
+    chr, pos, ref, compRef = key
+    stmt = q.register('dbSNP', 'select * from dbSNP where CHR=%s AND ' + \
+        'POS=%s AND ( REF=%s OR REF =%s )  AND INFO = %s ;')
+    return stmt.run(cursor, (str(chr), int(pos), str(ref), str(compRef), 
+        varclass))
+
+
+"""dbSNP rows for a batch of (chr, pos, ref, compRef) keys, one list per key
+   in the order of the keys. Runs one multi-position query per chromosome
+   and joins the rows back to the keys in memory; REF and CHR are compared
+   case-insensitively, as MySQL does for the per-key query.
+"""
+def fetchDbSnpBatch(cursor, keys, varclass='SNV'):
+    positions = {}
+    for chr, pos, ref, compRef in keys:
+        positions.setdefault(chr, set()).add(int(pos))
+
+    # A sequence parameter is bound as a parenthesized value list
+    stmt = q.register('dbSNP batch', 'select CHR, POS, REF, dbSNP.* from ' + \
+        'dbSNP where CHR=%s AND POS IN %s AND INFO = %s ;')
+    found = {}
+    for rows in stmt.runEach(cursor, [(str(chr), tuple(sorted(positions[chr])),
+        varclass) for chr in positions]):
+        for row in rows:
+            found.setdefault((str(row[0]).upper(), int(row[1])), []).append(row)
+
+    results = []
+    for chr, pos, ref, compRef in keys:
+        refs = (ref.upper(), compRef.upper())
+        rows = []
+        for row in found.get((chr.upper(), int(pos)), []):
+            if (str(row[2]).upper() in refs):
+                rows.append(row[3:])
+        results.append(rows)
+
+    return results
+
+
+"""dbSNP rows for one (chr, pos, ref, compRef) key from an interval index
+"""
+def fetchDbSnpIndexed(index, key, varclass='SNV'):
+    chr, pos, ref, compRef = key
+    refcol = index.columns.index('REF')
+    infocol = index.columns.index('INFO')
+    refs = (ref.upper(), compRef.upper())
+    rows = []
+    for row in index.stab(chr, int(pos)):
+        if (str(row[refcol]).upper() in refs and 
+            str(row[infocol]).upper() == varclass.upper()):
+            rows.append(row)
+
+    return rows
+
+
+"""Adds dbSNP ids and GMAF to a VCF record (see vcfrecord.py), returns
+   the record
+"""
+def addDbSnpRows(rec, rows, varclass='SNV'):
+    fields = rec.fields
+    fields[2] = '.'
+    rsids = []
+    mafs = []
+    if (len(rows) > 0):
+        for row in rows:
+            rsids.append(str(row[3]))
+            if (str(row[7]) != '.'):
+                mafs.append('GMAF=' + str(row[7]))
+
+        maf_str=''
+        if (len(mafs) > 0):
+            maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+        if (str(rec.info) == '.'):
+            rec.info.set('DB' + maf_str)
         else:
-            fh_out.write(line + '\n')
+            rec.info.append(';DB;VC=' + varclass + maf_str)
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+        fields[2] = str(';'.join(rsids))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    ## reset rsid to "." - in case there was annotation from old release of dbSNP
+    return rec
 
 
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
+    With batch_size > 1 up to batch_size records are buffered and the
+    candidates of all three tables are fetched together (see
+    fetchBigRefGeneBatch); the same precedence is then applied in memory.
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+def getBigRefGeneStage(lines, log, format='vcf', sep='\t', use_index=False,
+    batch_size=1):
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    if use_index:
+        cursor = None
+        baseIndex = intervals.load('chrom_pos_equal_base', 'CHR', 'start', 
+            'start')
+        nobaseIndex = intervals.load('chrom_pos_equal_nobase', 'CHR', 'start',
+            'start')
+        unequalIndex = intervals.load('chrom_pos_unequal', 'CHR', 'start', 
+            'end')
+        refcol = baseIndex.columns.index('haplotypeReference')
+        altcol = baseIndex.columns.index('haplotypeAlternate')
+    else:
+        baseIndex = nobaseIndex = unequalIndex = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
+    stmt1 = q.register('chrom_pos_equal_base', 'select * from ' + \
+        'chrom_pos_equal_base where CHR=%s AND start = %s AND ' + \
+        '((haplotypeReference=%s AND haplotypeAlternate =%s) OR ' + \
+        '(haplotypeReference=%s AND haplotypeAlternate =%s));')
+    stmt2 = q.register('chrom_pos_equal_nobase', 'select * from ' + \
+        'chrom_pos_equal_nobase where CHR=%s AND start = %s;')
+    stmt3 = q.register('chrom_pos_unequal', 'select * from ' + \
+        'chrom_pos_unequal where CHR=%s AND start <= %s AND %s <= end ;')
     vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
+    records = []
+
+    def flush():
+        found = sites.lookupMany('bigRefGene batch', 
+            [key for rec, key in records], 
+            lambda keys: fetchBigRefGeneBatch(cursor, keys))
+        for (rec, key), rows in zip(records, found):
+            yield addBigRefGeneRows(rec, rows)
+        del records[:]
+
+    for line in lines:
+        rec = vcfrecord.parse(line, sep)
+        if rec is not None:
+            fields = rec.fields
             chr = fields[inds[0]].strip()
             if chr.startswith("chr"):
                 chr = chr.replace('chr', '')
@@ -224,96 +523,157 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
             compRef = getComplementary(ref)
             compAlt = getComplementary(alt)
 
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+            if (batch_size > 1 and not use_index):
+                records.append((rec, (chr, pos, ref, alt, compRef, compAlt)))
+                if (len(records) >= batch_size):
+                    yield from flush()
+                vcf_linenum = vcf_linenum + 1
+                continue
+
+            params1 = (str(chr), int(pos), str(ref), str(alt), str(compRef),
+                str(compAlt))
+            params2 = (str(chr), int(pos))
+            params3 = (str(chr), int(pos), int(pos))
+
+            def isHaplotype(row):
+                hap = (str(row[refcol]).upper(), str(row[altcol]).upper())
+                return hap in ((ref.upper(), alt.upper()), 
+                    (compRef.upper(), compAlt.upper()))
+
+            rows = fetchRegion(cursor, stmt1, params1, baseIndex, chr, pos, 
+                match=isHaplotype)
+            if (len(rows) == 0):
+                rows = fetchRegion(cursor, stmt2, params2, nobaseIndex, chr, 
+                    pos)
+            if (len(rows) == 0):
+                rows = fetchRegion(cursor, stmt3, params3, unequalIndex, chr, 
+                    pos)
+            yield addBigRefGeneRows(rec, rows)
 
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
+            vcf_linenum = vcf_linenum + 1
 
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
+        else:
+            if (len(records) > 0):
+                yield from flush()
+            yield line.strip()
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+    if (len(records) > 0):
+        yield from flush()
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+    if not use_index:
+        conn.close()
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+"""Adds the collapsed bigRefGene rows to a VCF record, returns the record
+"""
+def addBigRefGeneRows(rec, rows):
+    if (len(rows) == 0):
+        return rec
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+    m = set([])
+    for row in rows:
+        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+    rec.info.append(';' + ';'.join(m))
+    if (str(rec.info).startswith(".;")):
+        rec.info.set(str(rec.info).replace('.;', '', 1))
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+    return rec
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+# Widest interval in chrom_pos_unequal, see unequalSpan()
+_unequalSpan = None
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+"""Largest end - start in chrom_pos_unequal, read once per process; bounds
+   the start range that can contain a position
+"""
+def unequalSpan(cursor):
+    global _unequalSpan
+    if (_unequalSpan is None):
+        stmt = q.register('chrom_pos_unequal span', 
+            'select max(end - start) from chrom_pos_unequal;')
+        row = stmt.run(cursor, (), one=True)
+        _unequalSpan = int(row[0]) if (row is not None and 
+            row[0] is not None) else 0
+    return _unequalSpan
+
+
+"""bigRefGene rows for a batch of (chr, pos, ref, alt, compRef, compAlt)
+   keys, one list per key in the order of the keys, with the precedence
+   of the per-key queries: chrom_pos_equal_base rows matching the
+   haplotype, else chrom_pos_equal_nobase rows, else the
+   chrom_pos_unequal intervals containing the position.
+   Runs one query over all three tables per chromosome and window of
+   positions; CHR and the haplotypes are compared case-insensitively, as
+   MySQL does for the per-key queries.
+"""
+def fetchBigRefGeneBatch(cursor, keys, window=1000000):
+    span = unequalSpan(cursor)
+    stmt = q.register('bigRefGene batch', 'select 1, t.* from ' + \
+        'chrom_pos_equal_base t where CHR=%s AND start IN %s ' + \
+        'union all select 2, t.* from chrom_pos_equal_nobase t where ' + \
+        'CHR=%s AND start IN %s ' + \
+        'union all select 3, t.* from chrom_pos_unequal t where ' + \
+        'CHR=%s AND start BETWEEN %s AND %s AND end >= %s;')
+
+    positions = {}
+    for chr, pos, ref, alt, compRef, compAlt in keys:
+        positions.setdefault(chr, set()).add(int(pos))
+
+    params = []
+    for chr in positions:
+        sorted_pos = sorted(positions[chr])
+        first = 0
+        for i in range(1, len(sorted_pos) + 1):
+            if (i == len(sorted_pos) or 
+                sorted_pos[i] - sorted_pos[first] > window):
+                group = tuple(sorted_pos[first:i])
+                params.append((str(chr), group, str(chr), group, str(chr),
+                    group[0] - span, group[-1], group[0]))
+                first = i
+
+    # Column 0 is the tier, then the table row: id, CHR, start, end,
+    # haplotypeReference, haplotypeAlternate, ... (see collapseRefSeq)
+    equal = ({}, {})
+    unequal = {}
+    for rows in stmt.runEach(cursor, params):
+        for row in rows:
+            tier = int(row[0])
+            row = row[1:]
+            chr = str(row[1]).upper()
+            if (tier < 3):
+                equal[tier - 1].setdefault((chr, int(row[2])), []).append(row)
+            else:
+                unequal.setdefault(chr, []).append(row)
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+    results = []
+    for chr, pos, ref, alt, compRef, compAlt in keys:
+        key = (chr.upper(), int(pos))
+        haps = ((ref.upper(), alt.upper()), (compRef.upper(), compAlt.upper()))
+        rows = [row for row in equal[0].get(key, []) 
+            if (str(row[4]).upper(), str(row[5]).upper()) in haps]
+        if (len(rows) == 0):
+            rows = equal[1].get(key, [])
+        if (len(rows) == 0):
+            rows = [row for row in unequal.get(key[0], [])
+                if (int(row[2]) <= key[1] and key[1] <= int(row[3]))]
+        results.append(rows)
 
-            vcf_linenum = vcf_linenum + 1
+    return results
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    use_index=False, batch_size=1):
+    runStage(getBigRefGeneStage, vcf, tmpextin, tmpextout, format=format,
+        sep=sep, use_index=use_index, batch_size=batch_size)
 
 
 """Get information about location in gene structures
+   With cpg_index, CpG islands are read from an in-memory interval index
+   even when the gene table is queried.
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+def getGenesStage(lines, log, format='vcf', table='refGene', 
+    promoter_offset=500, sep='\t', use_index=False, cpg_index=False):
 
     interGenic_count = 0
     cds_count = 0
@@ -326,15 +686,24 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     promoter_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    stmt = geneStatement(table, promoter_offset)
+    cpgStmt = regionStatement('cpgIslandExt', ', '.join(CPG_COLUMNS))
+    if use_index:
+        cursor = None
+        index = intervals.load(table, 'chrom', 'txStart', 'txEnd')
+    else:
+        index = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
+    cpgIndex = None
+    if (use_index or cpg_index):
+        cpgIndex = intervals.load('cpgIslandExt')
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
+    for line in lines:
+        rec = vcfrecord.parse(line, sep)
+        if rec is not None:
+            fields = rec.fields
             chr = fields[inds[0]].strip()
 
             if not chr.startswith("chr"):
@@ -343,25 +712,22 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
             pos = fields[inds[1]].strip()
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            rows = fetchRegion(cursor, stmt, (str(chr), int(promoter_offset),
+                int(pos), int(pos), int(promoter_offset)), index, chr, pos, 
+                offset=int(promoter_offset))
             info = []
 
             if (len(rows) > 0):
                 cnt = 1
+                # The CpG island of the variant is looked up on its first
+                # promoter hit and shared by all of its transcripts
+                cpgFetched = False
+                cpg = None
+                # positionType of the first bigRefGene isoform
+                positionType = clean_mysql_chars(rec.info.get('positionType'))
                 for row in rows:
                     #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
                     if (positionType == 'intron'):
                         intronic_count = intronic_count + 1
                     elif (positionType == 'non_coding_intron'):
@@ -380,8 +746,6 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                     cdsStart = int(row[6])
                     cdsEnd = int(row[7])
                     exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
                     geneSymbol = str(row[12])
                     strand = str(row[3])
 
@@ -390,56 +754,49 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
+                        for e in transcripts.model(row).exons(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum = exonCount - e
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
                         if (len(exons) > 0):
                             region = ";".join(exons)
                     elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
+                        for e in transcripts.model(row).exons(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum = exonCount - e
+                            exons.append("exon=" +  "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            exonic_count = exonic_count + 1
                         if (len(exons) > 0):
                             region = ";".join(exons)
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and 
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
+                        if not cpgFetched:
+                            cpg = fetchRegion(cursor, cpgStmt, 
+                                (str(chr), pos, pos), cpgIndex, chr, pos, 
+                                one=True, select=CPG_COLUMNS)
+                            cpgFetched = True
+
+                        if (cpg is not None):
                             region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
+                                "".join(str(cpg[3]).split())
                             promoter_count = promoter_count + 1
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
+                        if not cpgFetched:
+                            cpg = fetchRegion(cursor, cpgStmt, 
+                                (str(chr), pos, pos), cpgIndex, chr, pos, 
+                                one=True, select=CPG_COLUMNS)
+                            cpgFetched = True
+                        if (cpg is not None):
                             region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
+                                "".join(str(cpg[3]).split())
                             promoter_count = promoter_count + 1
 
                     else:
@@ -452,67 +809,56 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                     cnt = cnt + 1
 
                 str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                rec.info.append(';' + str_info)
+                yield rec
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
+                rec.info.append(";positionType=interGenic")
+                yield rec
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + '\n')
+            yield line.strip()
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+    summary(log, "Variants located:")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    summary(log, f"In interGenic {str(interGenic_count)}")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    summary(log, f"In CDS {str(cds_count)}")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    summary(log, f"In \'3 UTR {str(utr3_count)}")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    summary(log, f"In \'5 UTR {str(utr5_count)}")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+    summary(log, f"In Intronic {str(intronic_count)}")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    summary(log, f"In Non_coding_intronic {str(non_coding_intronic_count)}")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    summary(log, f"In Exonic {str(exonic_count)}")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+    summary(log, f"In Non_coding_exonic {str(non_coding_exonic_count)}")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    summary(log, f"In Putative Promoter Region {str(promoter_count)}")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    if not use_index:
+        conn.close()
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t', use_index=False, 
+    cpg_index=False):
+    runStage(getGenesStage, vcf, tmpextin, tmpextout, format=format,
+        table=table, promoter_offset=promoter_offset, sep=sep, 
+        use_index=use_index, cpg_index=cpg_index)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+   With cpg_index, CpG islands are read from an in-memory interval index.
+"""
+def getExonsEtAlStage(lines, log, format='vcf', table='refGene', 
+    promoter_offset=500, sep='\t', cpg_index=False):
 
     interGenic_count = 0
     cds_count = 0
@@ -525,15 +871,19 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     promoter_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+    stmt = geneStatement(table, promoter_offset)
+    cpgStmt = regionStatement('cpgIslandExt', ', '.join(CPG_COLUMNS))
     conn = u.db_connect()
     cursor = conn.cursor()
+    cpgIndex = None
+    if cpg_index:
+        cpgIndex = intervals.load('cpgIslandExt')
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
+    for line in lines:
+        rec = vcfrecord.parse(line, sep)
+        if rec is not None:
+            fields = rec.fields
             chr = fields[inds[0]].strip()
             
             if not chr.startswith("chr"):
@@ -542,26 +892,22 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
             pos = fields[inds[1]].strip()
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+
+            rows = fetchRegion(cursor, stmt, (str(chr), int(promoter_offset),
+                int(pos), int(pos), int(promoter_offset)), None, chr, pos)
             info = []
             if (len(rows) > 0):
                 cnt = 1
+                # The CpG island of the variant is looked up on its first
+                # promoter hit and shared by all of its transcripts
+                cpgFetched = False
+                cpg = None
                 for row in rows:
                     txtStart = int(row[4])
                     txtEnd = int(row[5])
                     cdsStart = int(row[6])
                     cdsEnd = int(row[7])
                     exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
                     geneSymbol = str(row[12])
                     strand = str(row[3])
 
@@ -570,18 +916,15 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                     region = ""
                     pos = int(pos)
                     exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
 
                     if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
+                        for e in transcripts.model(row).exons(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum =  exonCount - e
+                            exons.append("non_coding_exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            non_coding_exonic_count = non_coding_exonic_count + 1
                         if (len(exons) > 0):
                             region='positionType=non_coding_exon;' + ";".join(exons)
                         else:
@@ -590,14 +933,13 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
                         cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
+                        for e in transcripts.model(row).exons(pos):
+                            exnum = e + 1
+                            if (strand == '-'):
+                                exnum =  exonCount - e
+                            exons.append("exon=" + "ex" + \
+                                str(exnum) + '/' + str(exonCount))
+                            exonic_count=exonic_count+1
                         if (len(exons) > 0):
                             region = 'positionType=CDS;' + ";".join(exons)
                         else:
@@ -626,30 +968,28 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
                     elif (u.isBetween(pos, promoter_plus, txtStart) and \
                         (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
+                        if not cpgFetched:
+                            cpg = fetchRegion(cursor, cpgStmt, 
+                                (str(chr), pos, pos), cpgIndex, chr, pos, 
+                                one=True, select=CPG_COLUMNS)
+                            cpgFetched = True
+
+                        if (cpg is not None):
                             region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
+                                "".join(str(cpg[3]).split())
                             promoter_count = promoter_count + 1
 
                     elif (u.isBetween(pos, txtEnd, promoter_minus) and \
                         (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
+                        if not cpgFetched:
+                            cpg = fetchRegion(cursor, cpgStmt, 
+                                (str(chr), pos, pos), cpgIndex, chr, pos, 
+                                one=True, select=CPG_COLUMNS)
+                            cpgFetched = True
+
+                        if (cpg is not None):
                             region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
+                            "".join(str(cpg[3]).split())
                             promoter_count = promoter_count + 1
 
                     else:
@@ -663,92 +1003,91 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                     cnt = cnt + 1
 
                 str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                rec.info.append(';' + str_info)
+                yield rec
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
+                rec.info.append(";positionType=interGenic")
+                yield rec
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + '\n')
+            yield line.strip()
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+    summary(log, "Variants located:")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    summary(log, f"In interGenic {str(interGenic_count)}")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    summary(log, f"In CDS {str(cds_count)}")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    summary(log, f"In \'3 UTR {str(utr3_count)}")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    summary(log, f"In \'5 UTR {str(utr5_count)}")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+    summary(log, f"In Intronic {str(intronic_count)}")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    summary(log, f"In Non_coding_intronic {str(non_coding_intronic_count)}")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    summary(log, f"In Exonic {str(exonic_count)}")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+    summary(log, f"In Non_coding_exonic {str(non_coding_exonic_count)}")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    summary(log, f"In Putative Promoter Region {str(promoter_count)}")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
     conn.close()
 
 
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t', cpg_index=False):
+    runStage(getExonsEtAlStage, vcf, tmpextin, tmpextout, format=format,
+        table=table, promoter_offset=promoter_offset, sep=sep, 
+        cpg_index=cpg_index)
+
+
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+def addOverlapWithTfbsConsSitesStage(lines, log, format='vcf', 
+    table='tfbsConsSites', sep='\t', use_index=False, batch_size=1):
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    # One index per tfbsConsSites<chrom> table, loaded on first use
+    indexes = {}
+    if use_index:
+        cursor = None
+    else:
+        conn = u.db_connect()
+        cursor = conn.cursor()
 
     linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
+    for batch in vcfbatch.batches(lines, inds, sep, batch_size):
+        ## comments and header line
+        if isinstance(batch, str):
+            yield batch
+            continue
+
+        found = [None] * len(batch)
+        for name, members in batch.groups():
+            chrIndex = withChr(name).replace('chr', '')
+            if (use_index and chrIndex in allowed_chrom):
+                if chrIndex not in indexes:
+                    indexes[chrIndex] = intervals.load(
+                        'tfbsConsSites' + chrIndex)
+                if hasattr(indexes[chrIndex], 'stabMany'):
+                    stabGroup(indexes[chrIndex], batch, members, 
+                        withChr(name), found, select=TFBS_COLUMNS)
+
+        for rec, hits in zip(batch.records, found):
+            fields = rec.fields
             chr = fields[inds[0]].strip()
             # For some reason this table has no "chr" preceeding number
             if not chr.startswith("chr"):
@@ -760,12 +1099,18 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
 
             if (chrIndex in allowed_chrom):
                 isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                stmt = regionStatement('tfbsConsSites' + chrIndex, 
+                    'chrom, chromStart, chromEnd, name', chrom=None)
+                index = None
+                if use_index:
+                    if chrIndex not in indexes:
+                        indexes[chrIndex] = intervals.load(
+                            'tfbsConsSites' + chrIndex)
+                    index = indexes[chrIndex]
+                rows = hits
+                if (rows is None):
+                    rows = fetchRegion(cursor, stmt, (int(pos), int(pos)), 
+                        index, chr, pos, select=TFBS_COLUMNS)
                 records = []
 
                 if (len(rows) > 0):
@@ -780,348 +1125,332 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
                         records.append('tfbsRegion' + '=' + t)
                         records_count = records_count + 1
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+                    rec.info.add(';'.join(records))
 
-                    fh_out.write('\t'.join(fields) + '\n')
+            yield rec
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+            linenum = linenum + 1
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+    log.append(f"In {str(table)}: {str(var_count)} in " + \
+        f"{str(line_count)} variants\n")
 
-        linenum = linenum + 1
+    if not use_index:
+        conn.close()
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t', 
+    use_index=False, batch_size=1):
+    runStage(addOverlapWithTfbsConsSitesStage, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, use_index=use_index,
+        batch_size=batch_size)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def addOverlapWithGadAllStage(lines, log, format='vcf', 
+    table='gadAll', sep='\t', use_index=False,
+    batch_size=1):
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    stmt = regionStatement(table, chrom='chromosome')
+    if use_index:
+        index = intervals.load(table, 'chromosome')
+        cursor = None
+    else:
+        index = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
+    for batch in vcfbatch.batches(lines, inds, sep, batch_size):
+        ## comments and header line
+        if isinstance(batch, str):
+            yield batch
+            continue
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+        found = stabBatch(index, batch, withoutChr)
+        for rec, hits in zip(batch.records, found):
+            fields = rec.fields
+            chr = fields[inds[0]].strip()
+            # For some reason this table has no "chr" preceeding number
+            if chr.startswith("chr"):
+                chr = str(chr).replace("chr", "")
 
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+            pos = fields[inds[1]].strip()
+            isOverlap = False
 
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            rows = hits
+            if (rows is None):
+                rows = fetchRegion(cursor, stmt, (str(chr), int(pos), 
+                    int(pos)), index, chr, pos)
+            records = []
+
+            if (len(rows) > 0):
+                records_count = 1
+                line_count = line_count + 1
+                r_tmp = []
+                for row in rows:
+                    var_count = var_count + 1
+                    if not fu.isOnTheList(r_tmp, str(row[3])):
+                        r_tmp.append(str(row[3]) )
+                        records.append(str(table) + '=' + str(row[3]))
+                        records_count = records_count + 1
+                rec.info.add(';'.join(records))
+                # Columns are written back separated by tab and space
+                rec.pad()
+            yield rec
 
             linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
+    log.append(f"In {str(table)}: {str(var_count)} in " + \
         f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if not use_index:
+        conn.close()
 
 
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t', 
+    use_index=False, batch_size=1):
+    runStage(addOverlapWithGadAllStage, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, use_index=use_index,
+        batch_size=batch_size)
+
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+""" Overlap with gwasCatalog table """
+def addOverlapWithGwasCatalogStage(lines, log, format='vcf', 
+    table='gwasCatalog', sep='\t', use_index=False,
+    batch_size=1):
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    stmt = q.register(table + ' chromEnd', 'select * from ' + table + \
+        ' where chrom=%s AND chromEnd = %s;')
+    if use_index:
+        index = intervals.load(table, 'chrom', 'chromEnd', 'chromEnd')
+        cursor = None
+    else:
+        index = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
+    for batch in vcfbatch.batches(lines, inds, sep, batch_size):
+        ## comments and header line
+        if isinstance(batch, str):
+            yield batch
+            continue
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+        found = stabBatch(index, batch, withChr)
+        for rec, hits in zip(batch.records, found):
+            fields = rec.fields
+            chr = fields[inds[0]].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
+            
+            pos = fields[inds[1]].strip()
+            isOverlap = False
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+            rows = hits
+            if (rows is None):
+                rows = fetchRegion(cursor, stmt, (str(chr), int(pos)), index, 
+                    chr, pos)
+            records = []
+
+            if (len(rows) > 0):
+                line_count = line_count + 1
+                records_count = 1
+                for row in rows:
+                    var_count = var_count + 1
+                    records.append(str(table) + '=' + str('pubMedID') + \
+                        '=' + str(row[5]) + ',trait=' + str(row[10]))
+                    records_count = records_count + 1
+                rec.info.add(';'.join(records))
+            yield rec
 
             linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
+    log.append(f"In {str(table)}: {str(var_count)} in " + \
         f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if not use_index:
+        conn.close()
+
+
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', 
+    use_index=False, batch_size=1):
+    runStage(addOverlapWithGwasCatalogStage, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, use_index=use_index,
+        batch_size=batch_size)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def addOverlapWitHUGOGeneNomenclatureStage(lines, log, format='vcf', 
+    table='hugo', sep='\t', use_index=False,
+    batch_size=1):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    stmt = regionStatement(table)
+    if use_index:
+        index = intervals.load(table)
+        cursor = None
+    else:
+        index = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for batch in vcfbatch.batches(lines, inds, sep, batch_size):
+        ## comments and header line
+        if isinstance(batch, str):
+            yield batch
+            continue
 
-                pos=fields[inds[1]].strip()
-                isOverlap = False
+        found = stabBatch(index, batch, withChr)
+        for rec, hits in zip(batch.records, found):
+            fields = rec.fields
+            chr = fields[inds[0]].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
+            pos=fields[inds[1]].strip()
+            isOverlap = False
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
+            rows = hits
+            if (rows is None):
+                rows = fetchRegion(cursor, stmt, (str(chr), int(pos), 
+                    int(pos)), index, chr, pos)
+            records = []
+
+            if (len(rows) > 0):
+                line_count = line_count + 1
+                records_count = 1
+                r_tmp = []
+                for row in rows:
+                    var_count = var_count + 1
+                    t = str(str(row[5]) + ',' + str(row[6])).strip()
+                    if not fu.isOnTheList(r_tmp, t):
+                        r_tmp.append(t)
+                        records.append('HGNC_GeneAnnotation' + '=' + t)
+                    records_count = records_count + 1
 
-                    records_str = ','.join(records).replace(';', ',')
+                records_str = ','.join(records).replace(';', ',')
 
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+                rec.info.add(records_str)
+            yield rec
 
             linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
+    log.append(f"In {str(table)}: {str(var_count)} in " + \
         f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if not use_index:
+        conn.close()
+
+
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t', 
+    use_index=False, batch_size=1):
+    runStage(addOverlapWitHUGOGeneNomenclatureStage, vcf, tmpextin,
+        tmpextout, format=format, table=table, sep=sep, 
+        use_index=use_index,
+        batch_size=batch_size)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def addOverlapWithGenomicSuperDupsStage(lines, log, format='vcf', 
+    table='genomicSuperDups', sep='\t', use_index=False,
+    batch_size=1):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    stmt = regionStatement(table)
+    if use_index:
+        index = intervals.load(table)
+        cursor = None
+    else:
+        index = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+    for batch in vcfbatch.batches(lines, inds, sep, batch_size):
+        ## comments and header line
+        if isinstance(batch, str):
+            yield batch
+            continue
+
+        found = stabBatch(index, batch, withChr)
+        for rec, hits in zip(batch.records, found):
+            fields = rec.fields
+            chr = fields[inds[0]].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
+
+            pos = fields[inds[1]].strip()
+            isOverlap = False
+            otherChrom = ''
+            otherStart = ''
+            otherEnd = ''
+            l = str(isOverlap)
+
+            if (hits is None):
+                rows = fetchRegion(cursor, stmt, (str(chr), int(pos), 
+                    int(pos)), index, chr, pos, one=True)
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+                rows = hits[0] if (len(hits) > 0) else None
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
+            if rows is not None:
+                line_count = line_count + 1
+                var_count = var_count + 1
+                isOverlap = True
+                otherChrom = rows[7]
+                otherStart = rows[8]
+                otherEnd = rows[9]
+                rec.info.append(';' + str(table) + '=' + \
+                    str(isOverlap) + ';' + 'otherChrom=' + \
+                    str(otherChrom) + ';otherStart=' + \
+                    str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-                fh_out.write('\t'.join(fields) + '\n')
+            yield rec
 
             linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
+    log.append(f"In {str(table)}: {str(var_count)} in " + \
         f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if not use_index:
+        conn.close()
+
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t', 
+    use_index=False, batch_size=1):
+    runStage(addOverlapWithGenomicSuperDupsStage, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, use_index=use_index,
+        batch_size=batch_size)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+def addOverlapWithRefGeneStage(lines, log, format='vcf', 
+    table='refGene', sep='\t'):
+
     var_count = 0
     line_count = 0
     colindex = 1
@@ -1132,74 +1461,61 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     endName = 'txEnd'
 
     inds = getFormatSpecificIndices(format=format)
+    stmt = regionStatement(table, start=startName, end=endName)
     conn = u.db_connect()
     cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
+    for line in lines:
+        rec = vcfrecord.parse(line, sep)
         ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+        if rec is not None:
+            fields = rec.fields
+            chr = fields[inds[0]].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+            pos = fields[inds[1]].strip()
+            isOverlap = False
+            
+            overlapsWith = []
+            rows = fetchRegion(cursor, stmt, (str(chr), int(pos), int(pos)),
+                None, chr, pos)
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
+            if (len(rows) > 0):
+                line_count = line_count + 1
+                for row in rows:
+                    var_count = var_count + 1
+                    overlapsWith.append(name2 + '=' + \
+                        str(row[colindex2]) + ';' + name + '=' + \
+                        str(row[colindex]))
 
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+                genes = ';'.join([str(x) for x in overlapsWith])
+                rec.info.add(str(genes))
+            yield rec
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
+            yield line.strip()
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
+    log.append(f"In {str(table)}: {str(var_count)} in " + \
         f"{str(line_count)} variants\n")
-    fh_log.close()
 
     conn.close()
-    fh.close()
-    fh_out.close()
+
+
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(addOverlapWithRefGeneStage, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+def addOverlapWithCytobandStage(lines, log, format='vcf', 
+    table='cytoBand', sep='\t', use_index=False,
+    batch_size=1):
+
     var_count = 0
     line_count = 0
     colindex = 12
@@ -1212,192 +1528,191 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         endName = 'chromEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    stmt = regionStatement(table, start=startName, end=endName)
+    if use_index:
+        index = intervals.load(table, 'chrom', startName, endName)
+        cursor = None
+    else:
+        index = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for batch in vcfbatch.batches(lines, inds, sep, batch_size):
+        ## comments and header line
+        if isinstance(batch, str):
+            yield batch
+            continue
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+        found = stabBatch(index, batch, withChr)
+        for rec, hits in zip(batch.records, found):
+            fields = rec.fields
+            chr = fields[inds[0]].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
 
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
+            pos = fields[inds[1]].strip()
+            isOverlap = False
+            
+            overlapsWith = []
+            rows = hits
+            if (rows is None):
+                rows = fetchRegion(cursor, stmt, (str(chr), int(pos), 
+                    int(pos)), index, chr, pos)
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+            if (len(rows) > 0):
+                line_count = line_count + 1
+                for row in rows:
+                    var_count = var_count + 1
+                    overlapsWith.append(str(row[colindex]))
+                overlapsWith = u.dedup(overlapsWith)
+                cytoband = ';'.join([str(x) for x in overlapsWith])
+
+                rec.info.add(str(table) + '=' + str(cytoband))
+            yield rec
 
             linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
+    log.append(f"In {str(table)}: {str(var_count)} in " + \
         f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if not use_index:
+        conn.close()
+
+
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t', use_index=False, batch_size=1):
+    runStage(addOverlapWithCytobandStage, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, use_index=use_index,
+        batch_size=batch_size)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def addOverlapWithCnvDatabaseStage(lines, log, format='vcf', 
+    table='dgv_Cnv', sep='\t', use_index=False,
+    batch_size=1):
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    stmt = regionStatement(table)
+    if use_index:
+        index = intervals.load(table)
+        cursor = None
+    else:
+        index = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    for batch in vcfbatch.batches(lines, inds, sep, batch_size):
+        ## comments and header line
+        if isinstance(batch, str):
+            yield batch
+            continue
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+        found = stabBatch(index, batch, withChr)
+        for rec, hits in zip(batch.records, found):
+            fields = rec.fields
+            chr = fields[inds[0]].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
 
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+            pos = fields[inds[1]].strip()
+            isOverlap = False
+            if (hits is None):
+                rows = fetchRegion(cursor, stmt, (str(chr), int(pos), 
+                    int(pos)), index, chr, pos, one=True)
+            else:
+                rows = hits[0] if (len(hits) > 0) else None
+
+            if rows is not None:
+                line_count = line_count + 1
+                var_count = var_count + 1
+                isOverlap = True
+                rec.info.add(str(table) + '=' + str(isOverlap))
+            yield rec
 
             linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
+    log.append(f"In {str(table)}: {str(var_count)} in " + \
         f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if not use_index:
+        conn.close()
+
+
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t', use_index=False, batch_size=1):
+    runStage(addOverlapWithCnvDatabaseStage, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, use_index=use_index,
+        batch_size=batch_size)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def addOverlapWithMiRNAStage(lines, log, format='vcf', 
+    table='targetScanS', sep='\t', use_index=False,
+    batch_size=1):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    stmt = regionStatement(table)
+    if use_index:
+        index = intervals.load(table)
+        cursor = None
+    else:
+        index = None
+        conn = u.db_connect()
+        cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+    for batch in vcfbatch.batches(lines, inds, sep, batch_size):
+        ## comments and header line
+        if isinstance(batch, str):
+            yield batch
+            continue
+
+        found = stabBatch(index, batch, withChr)
+        for rec, hits in zip(batch.records, found):
+            fields = rec.fields
+            chr = fields[inds[0]].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
+
+            pos = fields[inds[1]].strip()
+            if (hits is None):
+                rows = fetchRegion(cursor, stmt, (str(chr), int(pos), 
+                    int(pos)), index, chr, pos, one=True)
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+                rows = hits[0] if (len(hits) > 0) else None
+
+            if rows is not None:
+                line_count = line_count + 1
+                var_count = var_count + 1
+                t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                    str(rows[2]) + '_' + str(rows[3])
+                t = 'miRNAsites=' + t.strip()
+                rec.info.add(t)
+            yield rec
 
             linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
+    log.append(f"In miRNAsites: {str(var_count)} in " + \
         f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    if not use_index:
+        conn.close()
+
+
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t', use_index=False, batch_size=1):
+    runStage(addOverlapWithMiRNAStage, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, use_index=use_index,
+        batch_size=batch_size)
 
 ### EOF
\ No newline at end of file
@@ -7,6 +7,7 @@ from boto3.dynamodb.conditions import Attr
 import subprocess
 import os
 import json
+import s3stream
 from configparser import ConfigParser
 
 # Initialize Config Parser
@@ -17,12 +18,21 @@ config.read("ann_config.ini")
 RUN = config['file']['Run']
 JOBS = config['file']['Jobs']
 
+# Stream the input from S3 into the job instead of downloading it first
+STREAM = config.getboolean('file', 'StreamS3', fallback=False)
 
-def run_annotation_job(file, uid, user):
-    """Runs the annotation job on the downloaded file"""
 
+def run_annotation_job(file, uid, user, source=None):
+    """
+        Runs the annotation job on the downloaded file, or in streaming
+        mode on the S3 (bucket, key) source, file then naming the job files
+    """
+
+    args = ['python', RUN, file, uid, user]
+    if source is not None:
+        args.extend(source)
     try:
-        subprocess.Popen(['python', RUN, file, uid, user],
+        subprocess.Popen(args,
                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
         return True
@@ -40,15 +50,14 @@ def download_file(bucket, key, uid, file):
     folder_path = os.path.join(JOBS, uid)
     os.makedirs(folder_path, exist_ok=True)
 
-    # Download the file from s3
+    # Download the file from s3, with the shared client and multipart
+    # settings (see s3stream.py); the throughput goes to the job log
     # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
     try:
-        s3 = boto3.client('s3', region_name=config['aws']['RegionName'])
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.download_fileobj
-        with open(os.path.join(folder_path, file), 'wb') as f:
-            s3.download_fileobj(bucket, key, f)
+        path = os.path.join(folder_path, file)
+        s3stream.logTransfer(folder_path, s3stream.download(bucket, key, path))
 
-        return os.path.join(folder_path, file), uid
+        return path, uid
     except ClientError:
         raise
 
@@ -67,15 +76,22 @@ def process_job(data):
         print("Bad Key to retrieve data:", e)
         return False
 
-    # Download the file and store it locally
-    try:
-        file, uid = download_file(bucket, key, job_id, upload_file)
-    except ClientError as e:
-        print("Unable to download file from S3:", e)
-        return False
+    # Download the file and store it locally, unless it is streamed
+    source = None
+    if STREAM:
+        folder_path = os.path.join(JOBS, job_id)
+        os.makedirs(folder_path, exist_ok=True)
+        file, uid = os.path.join(folder_path, upload_file), job_id
+        source = (bucket, key)
+    else:
+        try:
+            file, uid = download_file(bucket, key, job_id, upload_file)
+        except ClientError as e:
+            print("Unable to download file from S3:", e)
+            return False
 
     # Launch the annotation job
-    response = run_annotation_job(file, uid, user_id)
+    response = run_annotation_job(file, uid, user_id, source)
 
     # Change the job_status key in the annotations table to "RUNNING"
     if response:         # Make sure it was successful in launching the process
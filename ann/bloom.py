@@ -0,0 +1,210 @@
+# bloom.py
+#
+# Bloom filter over dbSNP (chrom, pos, ref) keys
+#
+# Build:  python bloom.py <snapshot_dir> <version> [false_positive_rate]
+#
+# The filter is written next to a reference snapshot, as
+# <snapshot_dir>/<version>/dbSNP.bloom (the bit array) and
+# dbSNP.bloom.json (its parameters). It is read from the snapshot's dbSNP
+# table when the version has one, otherwise from the reference database.
+# Both the REF of every row and its complement are added, so one probe
+# covers both strands of a variant. Readers memory-map the bit array.
+#
+##
+
+import os
+import sys
+import json
+import math
+import hashlib
+import numpy as np
+import pymysql
+import utils as u
+
+FILTER = 'dbSNP.bloom'
+PARAMS = 'dbSNP.bloom.json'
+
+COMPLEMENT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
+
+# Processes' filters already loaded, keyed by path
+_filters = {}
+
+# Filter consulted by the dbSNP stage, see useFilter()
+_active = None
+
+
+def normalize(chr, pos, ref):
+    """Key of a site as the dbSNP query compares it: chromosome without
+       'chr' and alleles case-insensitive
+    """
+    chr = str(chr)
+    if chr.startswith('chr'):
+        chr = chr.replace('chr', '')
+    return f"{chr.upper()}:{int(pos)}:{str(ref).upper()}".encode('utf-8')
+
+
+def hashes(key, k, m):
+    """k bit positions of a key (double hashing of one blake2b digest)"""
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % m for i in range(k)]
+
+
+def sizing(n, fp_rate):
+    """(bits, hash count) for n keys at a false-positive rate"""
+    n = max(n, 1)
+    m = int(math.ceil(-n * math.log(fp_rate) / (math.log(2) ** 2)))
+    k = max(1, int(round((m / float(n)) * math.log(2))))
+    return (max(m, 8), k)
+
+
+class BloomFilter(object):
+    """Bit array of m bits probed at k positions per key"""
+    def __init__(self, bits, m, k):
+        self.bits = bits
+        self.m = m
+        self.k = k
+
+    def add(self, key):
+        for b in hashes(key, self.k, self.m):
+            self.bits[b >> 3] |= (1 << (b & 7))
+
+    def __contains__(self, key):
+        for b in hashes(key, self.k, self.m):
+            if not (int(self.bits[b >> 3]) >> (b & 7)) & 1:
+                return False
+        return True
+
+    def mayContain(self, chr, pos, ref):
+        """False when dbSNP has no row for the site on either strand"""
+        return normalize(chr, pos, ref) in self
+
+
+def dbSnpRows(path):
+    """(row count, iterator of (CHR, POS, REF)) over dbSNP, from the
+       snapshot at path when it has the table, otherwise streamed from the
+       reference database
+    """
+    if os.path.isfile(os.path.join(path, 'manifest.json')):
+        import snapshot
+        snap = snapshot.Snapshot(os.path.dirname(path),
+            os.path.basename(path))
+        if 'dbSNP' in snap.manifest['tables']:
+            index = snap.index('dbSNP')
+            count = sum([c['rows'] for c in index.meta['chroms'].values()])
+            return (count, snapshotRows(index))
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    cursor.execute('select count(*) from dbSNP;')
+    count = int(cursor.fetchone()[0])
+    conn.close()
+    return (count, databaseRows())
+
+
+def snapshotRows(index):
+    refcol = index.columns.index('REF')
+    for chrom in sorted(index.meta['chroms']):
+        for start, end, ordinal, row in index.scan(chrom):
+            yield (chrom, start, row[refcol])
+
+
+def databaseRows():
+    conn = u.db_connect()
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    try:
+        cursor.execute('select CHR, POS, REF from dbSNP;')
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def build(root, version, fp_rate=0.01):
+    """Writes the dbSNP filter of root/<version>/, returns its path"""
+    path = os.path.join(root, version)
+    os.makedirs(path, exist_ok=True)
+
+    # Sized for every row and its complement
+    count, rows = dbSnpRows(path)
+    m, k = sizing(2 * count, fp_rate)
+    bits = np.zeros((m + 7) // 8, dtype=np.uint8)
+    bloom = BloomFilter(bits, m, k)
+    for chr, pos, ref in rows:
+        bloom.add(normalize(chr, pos, ref))
+        comp = COMPLEMENT.get(str(ref).upper(), '')
+        if (comp != ''):
+            bloom.add(normalize(chr, pos, comp))
+
+    # The parameters are written last, so readers never see a partial filter
+    bits.tofile(os.path.join(path, FILTER))
+    with open(os.path.join(path, PARAMS), 'w') as f:
+        json.dump({'version': version, 'bits': m, 'hashes': k,
+            'rows': count, 'fp_rate': fp_rate}, f, indent=1)
+
+    return os.path.join(path, FILTER)
+
+
+def versions(root):
+    """Snapshot versions under root with a complete dbSNP filter"""
+    if not os.path.isdir(root):
+        return []
+    return sorted([v for v in os.listdir(root)
+        if os.path.isfile(os.path.join(root, v, PARAMS))])
+
+
+def load(root, version=None):
+    """Memory-mapped dbSNP filter of a snapshot version (latest if None),
+       loaded once per process; a filter built for another version is
+       rejected with ValueError
+    """
+    if version is None:
+        found = versions(root)
+        if (len(found) == 0):
+            raise ValueError(f"No dbSNP filter found in {root}")
+        version = found[-1]
+
+    path = os.path.join(root, version)
+    if path not in _filters:
+        with open(os.path.join(path, PARAMS)) as f:
+            params = json.load(f)
+        if (params.get('version') != version):
+            raise ValueError(f"dbSNP filter in {path} was built for " + \
+                f"version {params.get('version')}, not {version}")
+        bits = np.memmap(os.path.join(path, FILTER), dtype=np.uint8, mode='r')
+        _filters[path] = BloomFilter(bits, params['bits'], params['hashes'])
+    return _filters[path]
+
+
+def useFilter(root, version=None):
+    """Makes the dbSNP stage consult the filter of the reference version
+       the database or snapshot queried holds; root None stops using a
+       filter. The version is required, as the latest filter may be of
+       another dbSNP release.
+    """
+    global _active
+    _active = None
+    if (root is not None):
+        if not version:
+            raise ValueError("dbSNP filter needs the reference version")
+        _active = load(root, version)
+    return _active
+
+
+def active():
+    """Filter in use by this process, None when there is none"""
+    return _active
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        fp_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+        print(f"dbSNP filter written to {build(sys.argv[1], sys.argv[2], fp_rate)}")
+    else:
+        print("Usage: python bloom.py <snapshot_dir> <version> " + \
+            "[false_positive_rate]")
+
+### EOF
@@ -12,110 +12,637 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import re
+import json
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from configparser import ConfigParser
 import file_utils as fu
 import annotate as ann
+import intervals
+import queries
+import transcripts
+import sites
+import sitestore
+import bloom
+import refschema
 
-def run(infile, format):
+# Initialize Config Parser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 
+    'ann_config.ini'))
+
+# Variants resolved per dbSNP query
+DBSNP_BATCH_SIZE = config.getint('annotate', 'DbSnpBatchSize', fallback=1)
+
+# Variants resolved per bigRefGene query over its three tables
+BIGREFGENE_BATCH_SIZE = config.getint('annotate', 'BigRefGeneBatchSize', 
+    fallback=1)
+
+# Variants of the region-overlap stages looked up together as NumPy
+# columns against in-memory and snapshot indexes
+OVERLAP_BATCH_SIZE = config.getint('annotate', 'OverlapBatchSize', 
+    fallback=1)
+
+# Local reference snapshot (see snapshot.py); when set, every stage reads
+# the memory-mapped snapshot and the reference database is not used
+SNAPSHOT = config.get('annotate', 'Snapshot', fallback='')
+SNAPSHOT_VERSION = config.get('annotate', 'SnapshotVersion', fallback='')
+LOCAL = (SNAPSHOT != '')
+
+# Serve region-overlap stages from in-memory interval indexes
+INDEXED = LOCAL or config.getboolean('annotate', 'IntervalIndex', 
+    fallback=False)
+
+# Preload the small gene-keyed tables (gadAll, gwasCatalog, hugo) into
+# in-memory indexes once per job (each job runs in its own process)
+# instead of a query per variant
+PRELOAD = LOCAL or config.getboolean('annotate', 'PreloadGeneTables', 
+    fallback=False)
+
+# Query the tables migrated by refschema.py through their UCSC bin indexes
+BIN_INDEX = config.getboolean('annotate', 'BinIndex', fallback=False)
+
+# Merge coordinate-sorted input with sorted reference streams instead of
+# random lookups, for the stages using indexes
+SWEEP = config.getboolean('annotate', 'Sweep', fallback=False)
+
+# Worker processes annotating shards of the input (1 = no sharding) and
+# positions per shard within a chromosome (0 = one shard per chromosome)
+WORKERS = config.getint('annotate', 'Workers', fallback=1)
+SHARD_SPAN = config.getint('annotate', 'ShardSpan', fallback=0)
+# 'chromosome' shards as above; 'chunk' gives each worker a byte range of
+# the input instead, with no serial pass splitting it (see runChunked)
+SHARD_BY = config.get('annotate', 'ShardBy', fallback='chromosome')
+
+# Record the stages completed by a job's chained run, so that a rerun of
+# the job on the same host resumes after them (see runChained)
+CHECKPOINT = config.getboolean('annotate', 'Checkpoint', fallback=False)
+
+# Write the annotated file as .annot.vcf.gz in bgzip blocks
+COMPRESS_OUTPUT = config.getboolean('annotate', 'CompressOutput', 
+    fallback=False)
+
+# Parsed refGene transcript models kept per process (see transcripts.py)
+TRANSCRIPT_CACHE_SIZE = config.getint('annotate', 'TranscriptCacheSize', 
+    fallback=transcripts.CACHE_SIZE)
+
+# Reference lookups memoized per site across stages (see sites.py)
+SITE_CACHE_SIZE = config.getint('annotate', 'SiteCacheSize', fallback=0)
+
+# Host-wide on-disk store of site lookups shared by all jobs (see
+# sitestore.py), kept per reference version: the snapshot's version, or
+# REFERENCE_VERSION when the reference database is used
+HOST_CACHE = config.get('annotate', 'HostCache', fallback='')
+HOST_CACHE_SIZE = config.getint('annotate', 'HostCacheSize', 
+    fallback=1000000)
+REFERENCE_VERSION = config.get('annotate', 'ReferenceVersion', fallback='')
+
+# Bloom filters of dbSNP sites (see bloom.py); the dbSNP stage skips the
+# lookup of sites the filter of the reference version rules out. Without a
+# known reference version no filter is used
+DBSNP_FILTER = config.get('annotate', 'DbSnpFilter', fallback='')
+
+# Lookups in flight per database-backed stage (> 1 runs those stages on a
+# thread pool, see concurrentStage) and records per concurrent chunk
+CONCURRENCY = config.getint('annotate', 'Concurrency', fallback=1)
+CONCURRENCY_CHUNK = config.getint('annotate', 'ConcurrencyChunk', 
+    fallback=100)
+
+"""Annotation stages in pipeline order: (message, stage, keyword arguments)
+"""
+STAGES = [
+    ("dbSNP", ann.getSnpsFromDbSnpStage, 
+        {'batch_size': DBSNP_BATCH_SIZE, 'use_index': LOCAL,
+        'use_filter': DBSNP_FILTER != ''}),
+    ("BigRefGene", ann.getBigRefGeneStage, 
+        {'batch_size': BIGREFGENE_BATCH_SIZE, 'use_index': LOCAL}),
+    ("BigRefGene", ann.getGenesStage, 
+        {'table': 'refGene', 'promoter_offset': 500, 'use_index': LOCAL,
+        'cpg_index': INDEXED}),
+    ("Cytoband", ann.addOverlapWithCytobandStage, 
+        {'table': 'cytoBand', 'use_index': INDEXED,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("gadAll", ann.addOverlapWithGadAllStage, 
+        {'table': 'gadAll', 'use_index': PRELOAD,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("GwasCatalog", ann.addOverlapWithGwasCatalogStage, 
+        {'table': 'gwasCatalog', 'use_index': PRELOAD,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("miRNA", ann.addOverlapWithMiRNAStage, 
+        {'table': 'targetScanS', 'use_index': INDEXED,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("HUGO Gene Nomenclature Committee", 
+        ann.addOverlapWitHUGOGeneNomenclatureStage, 
+        {'table': 'hugo', 'use_index': PRELOAD,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("dgv_Cnv", ann.addOverlapWithCnvDatabaseStage, 
+        {'table': 'dgv_Cnv', 'use_index': INDEXED,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("abParts_IG_T_CelReceptors", ann.addOverlapWithCnvDatabaseStage, 
+        {'table': 'abParts_IG_T_CelReceptors', 'use_index': INDEXED,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("mcCarroll_Cnv", ann.addOverlapWithCnvDatabaseStage, 
+        {'table': 'mcCarroll_Cnv', 'use_index': INDEXED,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("conrad_Cnv", ann.addOverlapWithCnvDatabaseStage, 
+        {'table': 'conrad_Cnv', 'use_index': INDEXED,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("genomicSuperDups", ann.addOverlapWithGenomicSuperDupsStage, 
+        {'table': 'genomicSuperDups', 'use_index': INDEXED,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+    ("addOverlapWithTfbsConsSites", ann.addOverlapWithTfbsConsSitesStage, 
+        {'table': 'tfbsConsSites', 'use_index': LOCAL,
+        'batch_size': OVERLAP_BATCH_SIZE}),
+]
+
+
+"""Name of the annotated file for an input file (.vcf or .vcf.gz)
+"""
+def annotatedName(infile):
+    if infile.endswith('.gz'):
+        infile = infile[:-len('.gz')]
+    return (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+
+
+"""Name of the final annotated file of a run, bgzip compressed (.gz) with
+   CompressOutput
+"""
+def resultName(infile):
+    return annotatedName(infile) + ('.gz' if COMPRESS_OUTPUT else '')
+
+
+"""Annotates infile. With stream, a pair (lines, writable), the lines are
+   annotated instead of infile's by the fused pipeline and written to the
+   writable (see s3stream.py); infile then only names the .count.log.
+   With Checkpoint, a job_id runs the chained pipeline checkpointed: a
+   rerun of the same job on the same host resumes after the stages it
+   completed.
+"""
+def run(infile, format, fused=None, stream=None, job_id=None):
 
     print("Running . . .")
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    if (fused is None):
+        fused = config.getboolean('annotate', 'Fused', fallback=False)
+
+    queries.reset()
+    sites.reset()
+    snapshot = useReferences()
+    if (snapshot is not None):
+        print(f"Using reference snapshot {snapshot.version}")
+
+    # Compressed input cannot be split into byte ranges
+    output = resultName(infile)
+    if (stream is not None):
+        annotateLines(infile, format, *stream)
+    elif (CHECKPOINT and job_id is not None):
+        runChained(infile, format, output, job_id)
+    elif (WORKERS > 1 and SHARD_BY == 'chunk' and not fu.isCompressed(infile)):
+        runChunked(infile, format, fused, WORKERS, output)
+    elif (WORKERS > 1):
+        runSharded(infile, format, fused, WORKERS, output)
+    elif fused:
+        runFused(infile, format, output=output)
+    else:
+        runChained(infile, format, output)
+
+    sites.flush()
+    if (sites._store is not None and WORKERS <= 1):
+        print(f"Host cache hit rate: {sites._store.hitRate():.1f}%")
+
+    for line in queries.report():
+        print(line)
+
+
+"""Selects the reference source of the indexed stages and sizes the
+   reference caches for this process; returns the snapshot in use, if any
+"""
+def useReferences():
+    transcripts.setCacheSize(TRANSCRIPT_CACHE_SIZE)
+    sites.setCacheSize(SITE_CACHE_SIZE)
+    snapshot = None
+    if LOCAL:
+        snapshot = intervals.useSnapshot(SNAPSHOT, SNAPSHOT_VERSION or None)
+    intervals.useSweep(SWEEP)
+    refschema.useSchema(BIN_INDEX and not LOCAL)
+
+    # Without a known reference version stored lookups could be stale
+    version = snapshot.version if (snapshot is not None) else REFERENCE_VERSION
+    store = None
+    if (HOST_CACHE != '' and version != ''):
+        store = sitestore.SiteStore(HOST_CACHE, version, HOST_CACHE_SIZE)
+    sites.useStore(store)
+
+    # A filter built from another dbSNP release would skip sites that are
+    # in the database queried, so it is only used for a known version
+    bloom.useFilter(None)
+    if (DBSNP_FILTER != '' and version != ''):
+        try:
+            bloom.useFilter(DBSNP_FILTER, version)
+        except (IOError, ValueError) as e:
+            print(f"dbSNP filter not used: {e}")
+    return snapshot
+
+
+"""STAGES as run by this process: in concurrent mode the stages querying
+   the reference database are wrapped by concurrentStage. In sweep mode
+   a stage with cpg_index builds a SweepIndex per run, which a run per
+   chunk would restart from the start of the chromosome, so such stages
+   run whole
+"""
+def pipeline():
+    if (CONCURRENCY <= 1):
+        return STAGES
+    return [(message, stage if (kwargs.get('use_index') or 
+        (SWEEP and kwargs.get('cpg_index'))) else 
+        concurrentStage(stage, CONCURRENCY, CONCURRENCY_CHUNK), kwargs)
+        for message, stage, kwargs in STAGES]
+
+
+"""Concurrent mode of a stage: the input is cut into chunks of chunk_size
+   lines and up to concurrency chunks are annotated at once, each by its
+   own run of the stage on a pool thread with its own pooled database
+   connection, so that many lookups are in flight instead of one. The
+   lookups block (pymysql has no asyncio driver), so this is plain
+   threading, not an event loop.
+   Output is yielded in input order and the chunks' .count.log lines are
+   merged as for shards (see mergeCountLogs); the chunks do not print
+   their summaries, the merged summary is printed once.
+"""
+def concurrentStage(stage, concurrency, chunk_size):
+    def annotate(chunk, kwargs):
+        log = ann.QuietLog()
+        return (list(stage(chunk, log, **kwargs)), log)
+
+    def run(lines, log, **kwargs):
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        pending = deque()
+        logs = []
+        chunk = []
+        try:
+            for line in lines:
+                chunk.append(line)
+                if (len(chunk) < chunk_size):
+                    continue
+                pending.append(executor.submit(annotate, chunk, kwargs))
+                chunk = []
+                if (len(pending) >= concurrency):
+                    out, chunk_log = pending.popleft().result()
+                    logs.append(chunk_log)
+                    yield from out
+
+            # An empty input still runs the stage once for its counters
+            if (len(chunk) > 0 or (len(pending) == 0 and len(logs) == 0)):
+                pending.append(executor.submit(annotate, chunk, kwargs))
+            while (len(pending) > 0):
+                out, chunk_log = pending.popleft().result()
+                logs.append(chunk_log)
+                yield from out
+        finally:
+            executor.shutdown()
+
+        for i, line in enumerate(mergeCountLogs(logs)):
+            if i in logs[0].printed:
+                ann.summary(log, line.rstrip('\n'))
+            else:
+                log.append(line)
+
+    return run
+
+
+"""Original pipeline: every stage is a full pass over the file and writes
+   its own intermediate infile.1 ... infile.N; the last is renamed to
+   output (annotatedName by default) or, for a .gz output, compressed.
+   With a job_id each completed stage is recorded in the checkpoint
+   manifest, and the stages a previous run of the job completed are
+   skipped (see resumeStages).
+"""
+def runChained(infile, format, output=None, job_id=None):
+    tmpextin = ''
+    tmpextout = ''
+    stagenum = 1
+
+    checkpoint = None
+    done = []
+    if (job_id is not None):
+        checkpoint = checkpointRun(infile, format, job_id)
+        done = resumeStages(infile, checkpoint)
+        if (len(done) > 0):
+            print(f"Resuming job {job_id} after stage {len(done)}")
+            tmpextin = tmpextout = done[-1]['output']
+            sites.addCounters(done[-1]['sites'])
+
+    for message, stage, kwargs in pipeline():
+        if (stagenum <= len(done)):
+            stagenum = stagenum + 1
+            continue
+        tmpextout = '.' + str(stagenum)
+        logmode = 'w' if (stagenum == 1) else 'a'
+        ann.runStage(stage, infile, tmpextin, tmpextout, logmode=logmode, 
+            format=format, **kwargs)
+        print(f"{message} - done.")
+        if (checkpoint is not None):
+            done.append(stageCheckpoint(infile, stagenum, message, tmpextout))
+            saveCheckpoint(infile, checkpoint, done)
+        tmpextin = tmpextout
+        stagenum = stagenum + 1
+
+    fh_log = open(infile + '.count.log', 'a')
+    fh_log.writelines(sites.report())
+    fh_log.close()
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, len(STAGES)):
         fu.delete(infile + '.' + str(i))
+    fu.delete(checkpointName(infile))
+
+    if (output is None):
+        output = annotatedName(infile)
+    if output.endswith('.gz'):
+        fh = open(infile + tmpextout)
+        fh_out = fu.createText(output)
+        shutil.copyfileobj(fh, fh_out)
+        fh_out.close()
+        fh.close()
+        fu.delete(infile + tmpextout)
+    else:
+        os.rename(infile + tmpextout, output)
+
+
+"""Checkpoint manifest of the chained run of infile
+"""
+def checkpointName(infile):
+    return infile + '.checkpoint.json'
+
+
+"""What a checkpoint is valid for: the job, the checksum of its input and
+   the stages with their settings; a manifest of another run is ignored
+"""
+def checkpointRun(infile, format, job_id):
+    return {'job_id': job_id, 'format': format, 'input': fu.checksum(infile),
+        'stages': [f"{message}: {stage.__name__} {sorted(kwargs.items())}"
+            for message, stage, kwargs in STAGES]}
+
+
+"""Manifest entry of a completed stage: its output and the .count.log
+   written so far, with their checksums, and the site cache counters so
+   far, which a resumed run starts from
+"""
+def stageCheckpoint(infile, stagenum, message, tmpextout):
+    log = infile + '.count.log'
+    return {'stage': stagenum, 'message': message, 'output': tmpextout,
+        'checksum': fu.checksum(infile + tmpextout),
+        'log_size': fu.fileSize(log), 'log_checksum': fu.checksum(log),
+        'sites': sites.counters()}
+
+
+"""Writes the manifest of the completed stages; it is replaced at once,
+   so a run killed while writing it leaves the previous one
+"""
+def saveCheckpoint(infile, checkpoint, done):
+    name = checkpointName(infile)
+    fh = open(name + '.tmp', 'w')
+    json.dump({'run': checkpoint, 'stages': done}, fh, indent=1)
+    fh.close()
+    os.replace(name + '.tmp', name)
+
+
+"""Completed stages of a previous run to resume from: the manifest's
+   stages up to the last whose output still matches its checksum. The
+   .count.log is cut back to its state after that stage; when it no
+   longer matches either, nothing is resumed.
+"""
+def resumeStages(infile, checkpoint):
+    try:
+        fh = open(checkpointName(infile))
+        manifest = json.load(fh)
+        fh.close()
+    except (IOError, ValueError):
+        return []
+    if (manifest.get('run') != checkpoint):
+        return []
+
+    done = []
+    for entry in manifest['stages']:
+        if (fu.checksum(infile + entry['output']) != entry['checksum']):
+            break
+        done.append(entry)
+
+    log = infile + '.count.log'
+    if (len(done) == 0):
+        return done
+    last = done[-1]
+    if (not fu.isExist(log) or fu.fileSize(log) < last['log_size']):
+        return []
+    os.truncate(log, last['log_size'])
+    if (fu.checksum(log) != last['log_checksum']):
+        return []
+    return done
+
+
+"""Fused pipeline: each record is read once and streamed through the
+   whole chain of stages, so no intermediate files are written.
+   Output and .count.log are identical to runChained. The input lines are
+   read from infile unless given; output defaults to annotatedName.
+"""
+def runFused(infile, format, lines=None, output=None):
+    fh = None
+    if (lines is None):
+        fh = fu.openText(infile)
+        lines = fh
+
+    fh_out = fu.createText(output or annotatedName(infile))
+    annotateLines(infile, format, lines, fh_out)
+    fh_out.close()
+    if (fh is not None):
+        fh.close()
+
+
+"""Streams lines through the whole chain of stages to the writable
+   fh_out, which is left open; the counters go to infile + '.count.log'
+"""
+def annotateLines(infile, format, lines, fh_out):
+    log = []
+    for message, stage, kwargs in pipeline():
+        lines = stage(lines, log, format=format, **kwargs)
+
+    for line in lines:
+        fh_out.write(str(line) + '\n')
+
+    fh_log = open(infile + '.count.log', 'w')
+    fh_log.writelines(log + sites.report())
+    fh_log.close()
+    print("All stages - done.")
+
+
+"""Shard of a data line: its chromosome, or chromosome and position range
+   when span > 0
+"""
+def shardKey(line, inds, span=0):
+    fields = line.split('\t', max(inds[0], inds[1]) + 1)
+    chr = fields[inds[0]].strip()
+    if (span > 0):
+        return (chr, int(fields[inds[1]]) // span)
+    return chr
+
+
+"""Runs the pipeline on one shard file in a worker process; returns the
+   shard's .count.log lines and the worker's query statistics. With chunk,
+   an (infile, start, end) byte range (see file_utils.splitFile), the
+   shard's lines are read from infile in place; chained stages still get
+   them copied to the shard file.
+"""
+def annotateShard(shard, format, fused, chunk=None):
+    queries.reset()
+    sites.reset()
+    if (chunk is not None and fused):
+        runFused(shard, format, fu.chunkLines(*chunk))
+    elif fused:
+        runFused(shard, format)
+    else:
+        if (chunk is not None):
+            fh = open(shard, 'w')
+            fh.writelines(fu.chunkLines(*chunk))
+            fh.close()
+        runChained(shard, format)
+    sites.flush()
+
+    fh_log = open(shard + '.count.log')
+    log = fh_log.readlines()
+    fh_log.close()
+    return (log, queries.stats())
+
+
+"""Combines the .count.log lines of several shards into those of a
+   serial run: counters are summed line by line, the 'Total' of each shard
+   counts one extra line and the dbSNP ratio is recomputed from the sums
+"""
+def mergeCountLogs(logs):
+    merged = []
+    for lines in zip(*logs):
+        counts = [[int(n) for n in re.findall(r'(?<= )\d+(?=\s)', line)]
+            for line in lines]
+        sums = [sum(c) for c in zip(*counts)]
+        if lines[0].startswith('Total: '):
+            sums = [sums[0] - (len(lines) - 1)]
+        parts = iter([str(n) for n in sums])
+        line = re.sub(r'(?<= )\d+(?=\s)', lambda m: next(parts), lines[0])
+        merged.append(line)
+
+    total = None
+    for i, line in enumerate(merged):
+        if line.startswith('Total: '):
+            total = int(line.split()[1])
+        elif (line.startswith('In dbSNP: ') and total is not None):
+            var_count = int(line.split()[2])
+            ratioInDbSnp = (var_count / float(total)) * 100
+            merged[i] = f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n"
+
+    return merged
+
+
+"""Sharded pipeline: data lines are split by chromosome (and position
+   range, see ShardSpan) into infile.shardN files, the shards are annotated
+   in a pool of worker processes and their outputs are merged back in
+   input order. Shards are written and read back through a FilePool, so
+   there can be far more of them than open files. An input without data
+   lines is run as one empty shard for its counters. Output and .count.log
+   are identical to a serial run.
+"""
+def runSharded(infile, format, fused, workers, output):
+    inds = ann.getFormatSpecificIndices(format=format)
+    shards = {}
+    names = []
+
+    shardFiles = fu.FilePool('w')
+    fh = fu.openText(infile)
+    for line in fh:
+        if line.startswith('#'):
+            continue
+        key = shardKey(line, inds, SHARD_SPAN)
+        if key not in shards:
+            shards[key] = len(names)
+            names.append(infile + '.shard' + str(len(names)))
+        shardFiles.write(names[shards[key]], line)
+    fh.close()
+    shardFiles.close()
+    if (len(names) == 0):
+        names.append(infile + '.shard0')
+        open(names[0], 'w').close()
+
+    print(f"Annotating {len(names)} shards with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers, 
+        initializer=useReferences) as pool:
+        results = list(pool.map(annotateShard, names, [format] * len(names), 
+            [fused] * len(names)))
+    logs = [log for log, counts in results]
+    for log, counts in results:
+        queries.merge(counts)
+
+    # Header lines pass through every stage unchanged
+    outputs = fu.FilePool('r')
+    fh = fu.openText(infile)
+    fh_out = fu.createText(output)
+    for line in fh:
+        if line.startswith('#'):
+            fh_out.write(line.strip() + '\n')
+        else:
+            fh_out.write(outputs.readline(annotatedName(
+                names[shards[shardKey(line, inds, SHARD_SPAN)]])))
+    fh_out.close()
+    fh.close()
+    outputs.close()
+
+    for name in names:
+        fu.delete(name)
+        fu.delete(annotatedName(name))
+        fu.delete(name + '.count.log')
+
+    fh_log = open(infile + '.count.log', 'w')
+    fh_log.writelines(mergeCountLogs(logs))
+    fh_log.close()
+    print("All shards - done.")
+
+
+"""Chunked pipeline: the input body is cut into one range of whole lines
+   per worker (see file_utils.splitFile) and each worker annotates its
+   range read in place from the input, so the workers start without a
+   serial pass over the file. Outputs are concatenated in order behind
+   the header. An input without data lines is run as one empty chunk for
+   its counters. Output and .count.log are identical to a serial run.
+"""
+def runChunked(infile, format, fused, workers, output):
+    header, chunks = fu.splitFile(infile, workers)
+    if (len(chunks) == 0):
+        chunks = [(header[1], header[1])]
+    names = [infile + '.chunk' + str(i) for i in range(len(chunks))]
+    print(f"Annotating {len(names)} chunks with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers, 
+        initializer=useReferences) as pool:
+        results = list(pool.map(annotateShard, names, [format] * len(names), 
+            [fused] * len(names), [(infile,) + c for c in chunks]))
+    logs = [log for log, counts in results]
+    for log, counts in results:
+        queries.merge(counts)
+
+    # Header lines pass through every stage unchanged
+    fh_out = fu.createText(output)
+    for line in fu.chunkLines(infile, *header):
+        fh_out.write(line.strip() + '\n')
+    for name in names:
+        output = open(annotatedName(name))
+        shutil.copyfileobj(output, fh_out)
+        output.close()
+        fu.delete(name)
+        fu.delete(annotatedName(name))
+        fu.delete(name + '.count.log')
+    fh_out.close()
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    fh_log = open(infile + '.count.log', 'w')
+    fh_log.writelines(mergeCountLogs(logs))
+    fh_log.close()
+    print("All chunks - done.")
 
-### EOF
\ No newline at end of file
+### EOF
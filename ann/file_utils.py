@@ -13,11 +13,17 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import os.path
 import linecache
 import csv
+import gzip
+import hashlib
+import mmap
 import os
 import shutil
+import struct
 import sys
+import zlib
 
 import itertools, operator
+from collections import OrderedDict
 
 """Execute command
 """
@@ -221,11 +227,112 @@ def readindices(filename, sep='\t'):
 """"Count number of lines in file, file is not loaded to memory
 """
 def linecount(filename):
-    fh = open(filename, "r")
-    linenum = 0
-    for line in fh:
-        linenum = linenum + 1
-    return linenum
+    return countLines(filename)
+
+
+# Bytes scanned at a time by countLines
+COUNT_BLOCK = 1 << 20
+
+
+"""SHA-256 hex digest of a file's contents, None when it does not exist
+"""
+def checksum(filename):
+    if not isExist(filename):
+        return None
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        for block in iter(lambda: fh.read(COUNT_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+"""Memory map of a file opened for reading, None for an empty file
+   (which cannot be mapped)
+"""
+def mapFile(filename):
+    with open(filename, "rb") as fh:
+        if (os.fstat(fh.fileno()).st_size == 0):
+            return None
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+"""Number of lines in the byte range [start, end) of a file (to the end of
+   the file when end is None), counting a last line without a newline;
+   newlines are counted a block at a time over the memory map
+"""
+def countLines(filename, start=0, end=None):
+    mm = mapFile(filename)
+    if mm is None:
+        return 0
+    try:
+        end = len(mm) if (end is None) else min(end, len(mm))
+        count = 0
+        for block in range(start, end, COUNT_BLOCK):
+            count = count + mm[block:min(block + COUNT_BLOCK, end)].count(b'\n')
+        if (end > start and mm[end - 1:end] != b'\n'):
+            count = count + 1
+        return count
+    finally:
+        mm.close()
+
+
+"""Splits a file into its header, the leading lines starting with
+   commentchar, and at most n byte ranges of the rest aligned to line
+   starts, so that each range can be read on its own (see chunkLines).
+   Returns (header range, [body ranges]) as (start, end) offsets; ranges
+   are of about equal size and empty ones are left out.
+"""
+def splitFile(filename, n, commentchar='#'):
+    mm = mapFile(filename)
+    if mm is None:
+        return ((0, 0), [])
+    try:
+        size = len(mm)
+        prefix = commentchar.encode()
+        body = 0
+        while (body < size and mm[body:body + len(prefix)] == prefix):
+            body = nextLine(mm, body)
+
+        bounds = [body]
+        for i in range(1, max(n, 1)):
+            cut = body + ((size - body) * i) // n
+            # A cut inside a line moves to the start of the next one
+            if (cut > bounds[-1] and mm[cut - 1:cut] != b'\n'):
+                cut = nextLine(mm, cut)
+            bounds.append(max(cut, bounds[-1]))
+        bounds.append(size)
+        chunks = [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)
+            if (bounds[i] < bounds[i + 1])]
+        return ((0, body), chunks)
+    finally:
+        mm.close()
+
+
+"""Offset of the line after the one holding offset pos
+"""
+def nextLine(mm, pos):
+    newline = mm.find(b'\n', pos)
+    return len(mm) if (newline < 0) else newline + 1
+
+
+"""Lines of the byte range [start, end) of a file, as returned by
+   splitFile, read in place from the memory map; lines keep their newline
+   as when iterating over the file
+"""
+def chunkLines(filename, start, end):
+    mm = mapFile(filename)
+    if mm is None:
+        return
+    try:
+        pos = start
+        end = min(end, len(mm))
+        while (pos < end):
+            newline = mm.find(b'\n', pos, end)
+            stop = end if (newline < 0) else newline + 1
+            yield mm[pos:stop].decode()
+            pos = stop
+    finally:
+        mm.close()
 
 
 """Saves list of rows and columns in a text file
@@ -245,4 +352,132 @@ def save2txt(read_data, txtfile, compress=False, debug=True):
     finally:
         f.close()
 
-### EOF
\ No newline at end of file
+# Leading bytes of gzip data (bgzip files included)
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Uncompressed bytes per BGZF block, as written by bgzip
+BGZF_BLOCK = 0xff00
+
+# Empty block ending every BGZF file
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC' + \
+    b'\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+"""Returns True for a gzip or bgzip compressed file
+"""
+def isCompressed(filename):
+    with open(filename, "rb") as fh:
+        return (fh.read(2) == GZIP_MAGIC)
+
+
+"""Opens a text file for reading, decompressing gzip and bgzip files on
+   the fly
+"""
+def openText(filename):
+    if isCompressed(filename):
+        return gzip.open(filename, "rt")
+    return open(filename, "r")
+
+
+"""Opens a text file for writing, as bgzip blocks when the name ends
+   with .gz
+"""
+def createText(filename):
+    if filename.endswith('.gz'):
+        return BgzfWriter(open(filename, "wb"))
+    return open(filename, "w")
+
+
+"""One BGZF block: a gzip member of data whose extra field 'BC' holds the
+   block size
+"""
+def bgzfBlock(data, level=6):
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = deflate.compress(data) + deflate.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 
+        ord('B'), ord('C'), 2, len(body) + 25)
+    return header + body + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class BgzfWriter(object):
+    """Text written in BGZF blocks to a binary file object, as bgzip does:
+    readable by any gzip reader and indexable by tabix. Closing the writer
+    closes the file object.
+    """
+    def __init__(self, fh, level=6):
+        self.fh = fh
+        self.level = level
+        self.buffer = bytearray()
+
+    def write(self, text):
+        self.buffer.extend(text.encode())
+        while (len(self.buffer) >= BGZF_BLOCK):
+            self.fh.write(bgzfBlock(bytes(self.buffer[:BGZF_BLOCK]), 
+                self.level))
+            del self.buffer[:BGZF_BLOCK]
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if (len(self.buffer) > 0):
+            self.fh.write(bgzfBlock(bytes(self.buffer), self.level))
+            self.buffer = bytearray()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Files a FilePool keeps open at once, well under the usual 1024 limit
+POOL_FILES = 128
+
+
+class FilePool(object):
+    """Many files written ('w') or read ('r') a line at a time through at
+    most size open handles. The least recently used file is closed when
+    another one is needed and reopened where it was left: appending, or
+    reading on from its offset. Reads are binary and decoded per line.
+    """
+    def __init__(self, mode, size=POOL_FILES):
+        self.mode = mode
+        self.size = size
+        self.files = OrderedDict()
+        self.offsets = {}
+
+    def get(self, path):
+        if path in self.files:
+            self.files.move_to_end(path)
+            return self.files[path]
+
+        if (len(self.files) >= self.size):
+            self.release(next(iter(self.files)))
+        if (self.mode == 'w'):
+            fh = open(path, 'a' if path in self.offsets else 'w')
+        else:
+            fh = open(path, 'rb')
+            fh.seek(self.offsets.get(path, 0))
+        self.files[path] = fh
+        return fh
+
+    def release(self, path):
+        fh = self.files.pop(path)
+        self.offsets[path] = fh.tell()
+        fh.close()
+
+    def write(self, path, text):
+        self.get(path).write(text)
+
+    def readline(self, path):
+        return self.get(path).readline().decode()
+
+    def close(self):
+        for path in list(self.files):
+            self.release(path)
+
+### EOF
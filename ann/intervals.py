@@ -0,0 +1,371 @@
+# intervals.py
+#
+# In-memory interval indexes over the reference region tables
+# (cytoBand, CNV tables, genomicSuperDups, targetScanS, ...) and the
+# small gene-keyed tables (gadAll, gwasCatalog, hugo)
+# and sweep-line merges for coordinate-sorted input
+#
+##
+
+import heapq
+import threading
+from bisect import bisect_left, bisect_right
+import numpy as np
+import pymysql
+import utils as u
+
+# Indexes already loaded by this process, keyed by (table, chrom, start, end)
+_indexes = {}
+
+# Memory-mapped reference snapshot serving load(), see useSnapshot()
+_snapshot = None
+
+# Answer load() with sweep-line merges, see useSweep()
+_sweep = False
+
+# Serializes loading for concurrent stages, so a table is read once
+_lock = threading.Lock()
+
+
+class NestedList(object):
+    """Nested containment list over the intervals of one chromosome.
+
+    Intervals are laid out so that every sublist is contiguous: the top
+    level first, then the intervals each interval contains. No interval
+    of a sublist contains another, so its starts and its ends both
+    increase and the intervals overlapping a query are one run found by
+    two binary searches; only the sublists of those intervals are
+    searched next. A query thus costs O(log n) per overlapping interval,
+    however long the intervals of the chromosome are.
+    nested holds, in layout order, the starts, ends, start-order indices
+    and the [sublo, subhi) layout range of each interval's sublist; the
+    top level is [0, top). Hits are returned as start-order indices, in
+    table order (the ordinals of the start-ordered intervals).
+    """
+    def __init__(self, nested, top, ordinals):
+        self.starts, self.ends, self.index, self.sublo, self.subhi = nested
+        self.top = top
+        self.ordinals = ordinals
+
+    @classmethod
+    def build(cls, starts, ends, ordinals):
+        """NestedList of intervals given in start order"""
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        # Containers come before the intervals they contain
+        order = np.lexsort((-ends, starts))
+        parent = np.full(len(starts), -1, dtype=np.int64)
+        stack = []
+        bounds = ends.tolist()
+        for i in order.tolist():
+            while (len(stack) > 0 and bounds[stack[-1]] < bounds[i]):
+                stack.pop()
+            if (len(stack) > 0):
+                parent[i] = stack[-1]
+            stack.append(i)
+
+        # Sublists keep start order and are keyed by their parent's index
+        # + 1, so the top level (key 0) comes first
+        layout = order[np.argsort(parent[order] + 1, kind='stable')]
+        keys = parent[layout] + 1
+        nested = np.stack((starts[layout], ends[layout], layout,
+            np.searchsorted(keys, layout + 1, side='left'),
+            np.searchsorted(keys, layout + 1, side='right')))
+        return cls(nested, int(np.searchsorted(keys, 0, side='right')),
+            np.asarray(ordinals, dtype=np.int64))
+
+    def _search(self, start, end, lists):
+        """Indices of the intervals of lists (layout ranges) and of their
+           sublists overlapping [start, end], in table order
+        """
+        found = []
+        while (len(lists) > 0):
+            a, b = lists.pop()
+            lo = a + int(self.ends[a:b].searchsorted(start, side='left'))
+            hi = a + int(self.starts[a:b].searchsorted(end, side='right'))
+            if (lo >= hi):
+                continue
+            found.append(self.index[lo:hi])
+            sublo = self.sublo[lo:hi]
+            subhi = self.subhi[lo:hi]
+            nested = (sublo < subhi).nonzero()[0]
+            if (len(nested) > 0):
+                lists.extend(zip(sublo[nested].tolist(),
+                    subhi[nested].tolist()))
+
+        if (len(found) == 0):
+            return []
+        hits = np.concatenate(found) if (len(found) > 1) else found[0]
+        if (len(hits) > 1):
+            hits = hits[np.argsort(self.ordinals[hits], kind='stable')]
+        return hits.tolist()
+
+    def overlap(self, start, end):
+        """Indices of the intervals overlapping [start, end]"""
+        return self._search(start, end, [(0, self.top)])
+
+    def stabMany(self, positions):
+        """Indices of the intervals containing each of positions (a NumPy
+           array); the top level is searched for all positions at once, so
+           only positions with hits are searched one by one
+        """
+        lo = np.searchsorted(self.ends[:self.top], positions, side='left')
+        hi = np.searchsorted(self.starts[:self.top], positions, side='right')
+        found = [[]] * len(positions)
+        for q in np.nonzero(lo < hi)[0]:
+            found[q] = self._search(positions[q], positions[q],
+                [(int(lo[q]), int(hi[q]))])
+        return found
+
+
+class IntervalIndex(object):
+    """Per-chromosome interval index over table rows.
+
+    Intervals of each chromosome are kept in a NestedList, so a region
+    lookup costs O(log n) per overlapping row, long intervals included,
+    and never leaves the process.
+    Rows are returned in table order, as the equivalent range query does.
+    """
+    def __init__(self, rows, chrom=0, start=1, end=2, columns=None):
+        self.columns = columns
+        self.chroms = {}
+        bychrom = {}
+        for ordinal, row in enumerate(rows):
+            bychrom.setdefault(str(row[chrom]), []).append(
+                (int(row[start]), ordinal, int(row[end]), row))
+
+        for name, entries in bychrom.items():
+            entries.sort(key=lambda e: (e[0], e[1]))
+            self.chroms[name] = (NestedList.build([e[0] for e in entries],
+                [e[2] for e in entries], [e[1] for e in entries]),
+                [e[3] for e in entries])
+
+    def overlap(self, chrom, start, end):
+        """Rows whose interval overlaps [start, end], in table order"""
+        if chrom not in self.chroms:
+            return []
+
+        nested, rows = self.chroms[chrom]
+        return [rows[i] for i in nested.overlap(start, end)]
+
+    def stab(self, chrom, pos):
+        """Rows whose interval contains pos, in table order"""
+        return self.overlap(chrom, pos, pos)
+
+    def stabMany(self, chrom, positions):
+        """stab() of every position of a NumPy array, vectorized"""
+        if chrom not in self.chroms:
+            return [[] for p in positions]
+
+        nested, rows = self.chroms[chrom]
+        return [[rows[i] for i in hits] for hits in nested.stabMany(positions)]
+
+
+class PointIndex(object):
+    """Per-chromosome hash map over table rows keyed by one position
+    column, for tables queried by equality on that column (gwasCatalog's
+    chromEnd). A position is answered by one dict lookup; ranges bisect
+    the sorted positions of the chromosome.
+    Rows are returned in table order, as the equivalent query does.
+    """
+    def __init__(self, rows, chrom=0, pos=1, columns=None):
+        self.columns = columns
+        self.chroms = {}
+        for ordinal, row in enumerate(rows):
+            self.chroms.setdefault(str(row[chrom]), {}).setdefault(
+                int(row[pos]), []).append((ordinal, row))
+        self.positions = dict([(name, sorted(points))
+            for name, points in self.chroms.items()])
+
+    def overlap(self, chrom, start, end):
+        """Rows whose position is in [start, end], in table order"""
+        if chrom not in self.chroms:
+            return []
+
+        points = self.chroms[chrom]
+        if (start == end):
+            return [row for ordinal, row in points.get(start, [])]
+
+        positions = self.positions[chrom]
+        found = []
+        for i in range(bisect_left(positions, start), 
+            bisect_right(positions, end)):
+            found.extend(points[positions[i]])
+        found.sort(key=lambda f: f[0])
+        return [row for ordinal, row in found]
+
+    def stab(self, chrom, pos):
+        """Rows whose position is pos, in table order"""
+        return self.overlap(chrom, pos, pos)
+
+    def stabMany(self, chrom, positions):
+        """stab() of every position of a NumPy array"""
+        points = self.chroms.get(chrom, {})
+        return [[row for ordinal, row in points.get(int(p), [])]
+            for p in positions]
+
+
+class SweepIndex(object):
+    """Sweep-line merge of coordinate-sorted queries with a coordinate-
+    sorted reference stream.
+
+    Rows of the current chromosome are read from the stream (the snapshot
+    when one is in use, otherwise an unbuffered 'order by start' query) only
+    as far as the queries have advanced, and kept in a heap keyed by end
+    until they can no longer overlap a later query. A sorted VCF is thus
+    annotated in O(N + M) with memory bounded by the number of active
+    intervals. A query that goes back in position, or returns to an
+    earlier chromosome, switches the index to indexed lookups through
+    load() for the rest of the run.
+    Overlapping rows are returned in table order for a snapshot stream and
+    in start order for a database stream.
+    """
+    def __init__(self, table, chrom='chrom', start='chromStart', 
+        end='chromEnd'):
+        self.table = table
+        self.key = (chrom, start, end)
+        self.fallback = None
+        self.current = None
+        self.seen = set()
+        self.stream = None
+        self.pending = None
+        self.active = []
+        self.last = None
+        self.conn = None
+
+        if _snapshot is not None:
+            self.source = _snapshot.index(table, chrom, start, end)
+            self.columns = self.source.columns
+        else:
+            self.source = None
+            self.conn = u.db_connect()
+            cursor = self.conn.cursor()
+            cursor.execute('select * from ' + table + ' limit 0;')
+            self.columns = [d[0] for d in cursor.description]
+            cursor.close()
+
+    def _rows(self, chrom):
+        if self.source is not None:
+            yield from self.source.scan(chrom)
+            return
+
+        start = self.columns.index(self.key[1])
+        end = self.columns.index(self.key[2])
+        cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+        try:
+            cursor.execute('select * from ' + self.table + ' where ' + \
+                self.key[0] + '=%s order by ' + self.key[1] + ';', (chrom,))
+            ordinal = 0
+            for row in cursor:
+                yield (int(row[start]), int(row[end]), ordinal, row)
+                ordinal = ordinal + 1
+        finally:
+            cursor.close()
+
+    def _advance(self, chrom, start, end):
+        """Moves the sweep to a query; False if the queries are unsorted"""
+        if (chrom != self.current):
+            if chrom in self.seen:
+                return False
+            self.seen.add(chrom)
+            self.current = chrom
+            if (self.stream is not None):
+                self.stream.close()
+            self.stream = self._rows(chrom)
+            self.pending = next(self.stream, None)
+            self.active = []
+        elif (start < self.last[0] or end < self.last[1]):
+            return False
+
+        self.last = (start, end)
+        return True
+
+    def close(self):
+        if (self.stream is not None):
+            self.stream.close()
+            self.stream = None
+        if (self.conn is not None):
+            self.conn.close()
+            self.conn = None
+
+    def overlap(self, chrom, start, end):
+        """Rows whose interval overlaps [start, end]"""
+        if (self.fallback is None and not self._advance(chrom, start, end)):
+            print(f"{self.table}: input is not coordinate-sorted, " + \
+                "switching to indexed lookups")
+            self.close()
+            self.fallback = load(self.table, *self.key, sweep=False)
+
+        if (self.fallback is not None):
+            return self.fallback.overlap(chrom, start, end)
+
+        while (self.pending is not None and self.pending[0] <= end):
+            heapq.heappush(self.active, 
+                (self.pending[1], self.pending[2], self.pending[3]))
+            self.pending = next(self.stream, None)
+
+        while (len(self.active) > 0 and self.active[0][0] < start):
+            heapq.heappop(self.active)
+
+        found = sorted([(ordinal, row) for e, ordinal, row in self.active],
+            key=lambda f: f[0])
+        return [row for ordinal, row in found]
+
+    def stab(self, chrom, pos):
+        """Rows whose interval contains pos"""
+        return self.overlap(chrom, pos, pos)
+
+
+def useSweep(enabled=True):
+    """Makes load() return a new SweepIndex per call, for stages reading
+       coordinate-sorted input
+    """
+    global _sweep
+    _sweep = enabled
+
+
+def useSnapshot(root, version=None):
+    """Serves every load() from a local reference snapshot (snapshot.py)
+       instead of the reference database
+    """
+    global _snapshot
+    import snapshot
+    _snapshot = snapshot.Snapshot(root, version)
+    return _snapshot
+
+
+def load(table, chrom='chrom', start='chromStart', end='chromEnd', 
+    sweep=None):
+    """Loads a reference table into an IntervalIndex (a PointIndex when
+       start and end are the same column) once per process.
+       In sweep mode returns a new SweepIndex instead, so call it once
+       per stage run.
+    """
+    if (sweep is None):
+        sweep = _sweep
+    if sweep:
+        return SweepIndex(table, chrom, start, end)
+
+    with _lock:
+        if _snapshot is not None:
+            return _snapshot.index(table, chrom, start, end)
+
+        key = (table, chrom, start, end)
+        if key not in _indexes:
+            conn = u.db_connect()
+            cursor = conn.cursor()
+            cursor.execute('select * from ' + table + ';')
+            columns = [d[0] for d in cursor.description]
+            if (start == end):
+                _indexes[key] = PointIndex(cursor.fetchall(),
+                    chrom=columns.index(chrom), pos=columns.index(start),
+                    columns=columns)
+            else:
+                _indexes[key] = IntervalIndex(cursor.fetchall(),
+                    chrom=columns.index(chrom), start=columns.index(start),
+                    end=columns.index(end), columns=columns)
+            conn.close()
+
+        return _indexes[key]
+
+### EOF
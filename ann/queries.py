@@ -0,0 +1,129 @@
+# queries.py
+#
+# Parameterized statements for the reference database queries
+#
+# Every query shape is registered once per process with register() and
+# run with bound parameters; values are escaped by the driver instead of
+# being pasted into the SQL text. pymysql binds them on the client, so
+# nothing is prepared on the server and every run is one round trip.
+# Each statement keeps its call count, rows returned and time spent, see
+# report(); counts merged from worker processes are kept apart, see
+# merge().
+#
+##
+
+import time
+import threading
+
+# Statements registered by this process, keyed by name
+_statements = {}
+
+# Counters merged from other processes, keyed by statement name
+_merged = {}
+
+# Guards registration and counters for concurrent stages
+_lock = threading.Lock()
+
+
+class Statement(object):
+    """One registered query shape with %s placeholders and its counters.
+    bind, if given, maps the parameters callers pass to the ones the SQL
+    takes, so a query can change shape without changing its callers.
+    """
+    def __init__(self, name, sql, bind=None):
+        self.name = name
+        self.sql = sql
+        self.bind = bind
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def run(self, cursor, params, one=False):
+        """Executes with one parameter tuple; returns all rows, or the
+           first row or None with one=True
+        """
+        if (self.bind is not None):
+            params = self.bind(params)
+        started = time.time()
+        cursor.execute(self.sql, params)
+        if one:
+            result = cursor.fetchone()
+            found = 0 if (result is None) else 1
+        else:
+            result = cursor.fetchall()
+            found = len(result)
+        with _lock:
+            self.seconds = self.seconds + (time.time() - started)
+            self.calls = self.calls + 1
+            self.rows = self.rows + found
+        return result
+
+    def runEach(self, cursor, paramsList):
+        """Executes once per parameter tuple, one round trip each; returns
+           one list of rows per tuple
+        """
+        return [self.run(cursor, params) for params in paramsList]
+
+
+def register(name, sql, bind=None):
+    """Registers a query shape under name once and returns its Statement"""
+    with _lock:
+        if name not in _statements:
+            _statements[name] = Statement(name, sql, bind)
+        elif (_statements[name].sql != sql):
+            raise ValueError(f"Statement {name} is already registered " + \
+                "with different SQL")
+        return _statements[name]
+
+
+def reset():
+    """Zeroes the counters of every registered statement and drops the
+       merged ones
+    """
+    for s in _statements.values():
+        s.calls = 0
+        s.rows = 0
+        s.seconds = 0.0
+    _merged.clear()
+
+
+def stats():
+    """{name: (calls, rows, seconds)} for every statement registered by
+       this process
+    """
+    return dict([(s.name, (s.calls, s.rows, s.seconds))
+        for s in _statements.values()])
+
+
+def merge(counts):
+    """Adds the stats() of another process to the report of this one.
+       They are kept apart from the registered statements, which forked
+       workers inherit and register() checks against their SQL
+    """
+    for name, (calls, rows, seconds) in counts.items():
+        total = _merged.get(name, (0, 0, 0.0))
+        _merged[name] = (total[0] + calls, total[1] + rows, 
+            total[2] + seconds)
+
+
+def report():
+    """One line per statement that has been run, here or in a merged
+       process: calls, rows and latency
+    """
+    counts = dict(_merged)
+    for name, (calls, rows, seconds) in stats().items():
+        total = counts.get(name, (0, 0, 0.0))
+        counts[name] = (total[0] + calls, total[1] + rows, 
+            total[2] + seconds)
+
+    lines = []
+    for name in sorted(counts):
+        calls, rows, seconds = counts[name]
+        if (calls == 0):
+            continue
+        lines.append(f"{name}: {calls} calls, {rows} rows, " + \
+            f"{seconds:.3f}s total, " + \
+            f"{(seconds / calls) * 1000:.3f}ms per call")
+    return lines
+
+### EOF
@@ -0,0 +1,210 @@
+# refschema.py
+#
+# UCSC bin indexes for the reference region tables
+#
+# Migrate:  python refschema.py [promoter_offset] [table ...]
+#
+# Range conditions such as "chromStart <= pos AND pos <= chromEnd" or the
+# promoter-widened "(txStart - 500) <= pos" cannot seek an index, so every
+# lookup scans the chromosome. The migration (re)computes each table's
+# UCSC 'bin' column and indexes it with the chromosome; gene tables also
+# get the promoter-widened bounds and their bin as columns. Migrated
+# tables are recorded in the refSchema table, and once useSchema() has
+# read it the region and gene statements restrict the range to the few
+# bins that can hold a position, which the index answers with seeks.
+# New columns are appended, so 'select *' rows keep their layout.
+#
+##
+
+import sys
+import threading
+import utils as u
+
+# UCSC standard binning: 128kb bins at the finest level, each level up
+# 8 times wider, 512Mb at the top; offsets of the first bin of each level
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_MAX = 1 << 29
+
+# Region tables: (chromosome column, interval start, interval end)
+TABLES = {
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+}
+for c in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13',
+    '14', '15', '16', '17', '18', '19', '20', '21', '22', 'X', 'Y']:
+    TABLES['tfbsConsSites' + c] = (None, 'chromStart', 'chromEnd')
+
+# Tables queried with promoter-widened transcript bounds
+GENE_TABLES = ['refGene']
+
+# Migrated tables read by useSchema(): {table: (start, end, offset)},
+# offset being the promoter offset of gene tables and None otherwise
+_tables = {}
+_lock = threading.Lock()
+
+
+def binFromRange(start, end):
+    """Smallest UCSC bin holding the half-open interval [start, end); an
+       empty interval is binned as its start. Same as binSql().
+    """
+    first = start >> BIN_FIRST_SHIFT
+    last = (end - 1 if (end > start) else start) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if (first == last):
+            return offset + first
+        first = first >> BIN_NEXT_SHIFT
+        last = last >> BIN_NEXT_SHIFT
+    return 0
+
+
+def overlappingBins(start, end):
+    """Every UCSC bin that can hold an interval overlapping the positions
+       start to end (both included)
+    """
+    start = max(start, 0) >> BIN_FIRST_SHIFT
+    end = min(max(end, 0), BIN_MAX - 1) >> BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start, offset + end + 1))
+        start = start >> BIN_NEXT_SHIFT
+        end = end >> BIN_NEXT_SHIFT
+    return tuple(bins)
+
+
+def binSql(start, end):
+    """SQL expression of binFromRange over two integer columns"""
+    end = '(case when ' + end + ' > ' + start + ' then ' + end + ' - 1 ' + \
+        'else ' + start + ' end)'
+    cases = []
+    shift = BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS[:-1]:
+        cases.append(f"when ({start} >> {shift}) = ({end} >> {shift}) " + \
+            f"then {offset} + ({start} >> {shift})")
+        shift = shift + BIN_NEXT_SHIFT
+    return 'case ' + ' '.join(cases) + ' else 0 end'
+
+
+def columnNames(cursor, table):
+    cursor.execute('select * from ' + table + ' limit 0;')
+    return [d[0] for d in cursor.description]
+
+
+def indexNames(cursor, table):
+    cursor.execute('select distinct index_name from ' + \
+        'information_schema.statistics where table_schema = database() ' + \
+        'and table_name = %s;', (table,))
+    return [r[0] for r in cursor.fetchall()]
+
+
+def migrate(tables=None, offset=500):
+    """Adds bin columns and (chromosome, bin) indexes to the region tables,
+       plus promoter bounds widened by offset to the gene tables
+    """
+    if tables is None:
+        tables = sorted(TABLES)
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    cursor.execute('create table if not exists refSchema (tableName ' + \
+        'varchar(64) primary key, startColumn varchar(64), endColumn ' + \
+        'varchar(64), promoterOffset int);')
+
+    for table in tables:
+        chrom, start, end = TABLES[table]
+        columns = columnNames(cursor, table)
+        # DDL commits at once, so a failed run can leave an index without
+        # its refSchema row; indexes are looked up rather than assumed
+        indexes = indexNames(cursor, table)
+        indexed = ('(' + chrom + ', bin)') if chrom else '(bin)'
+
+        # Existing UCSC bins are recomputed, so every row follows the
+        # convention binFromRange and overlappingBins agree on
+        if 'bin' not in columns:
+            cursor.execute('alter table ' + table + ' add column bin ' + \
+                'smallint unsigned;')
+        cursor.execute('update ' + table + ' set bin = ' + \
+            binSql(start, end) + ';')
+        if (table + '_bin') not in indexes:
+            cursor.execute('create index ' + table + '_bin on ' + table + \
+                ' ' + indexed + ';')
+
+        promoter = None
+        if table in GENE_TABLES:
+            promoter = int(offset)
+            for c in ['promoterStart', 'promoterEnd']:
+                if c not in columns:
+                    cursor.execute('alter table ' + table + ' add column ' + \
+                        c + ' int;')
+            if 'promoterBin' not in columns:
+                cursor.execute('alter table ' + table + ' add column ' + \
+                    'promoterBin smallint unsigned;')
+            # Signed: txStart - offset is negative near the chromosome start
+            cursor.execute('update ' + table + ' set promoterStart = ' + \
+                'cast(' + start + ' as signed) - %s, promoterEnd = ' + \
+                end + ' + %s;', (promoter, promoter))
+            cursor.execute('update ' + table + ' set promoterBin = ' + \
+                binSql('(case when promoterStart < 0 then 0 else ' + \
+                'promoterStart end)', 'promoterEnd') + ';')
+            if (table + '_promoterBin') not in indexes:
+                cursor.execute('create index ' + table + '_promoterBin ' + \
+                    'on ' + table + ' (' + chrom + ', promoterBin);')
+
+        cursor.execute('delete from refSchema where tableName = %s;', (table,))
+        cursor.execute('insert into refSchema values (%s, %s, %s, %s);',
+            (table, start, end, promoter))
+        conn.commit()
+        print(f"{table} - bin index added.")
+
+    conn.close()
+
+
+def useSchema(enabled=True):
+    """Reads the migrated tables from refSchema, so that statements of
+       those tables use their bin indexes; enabled=False stops using them
+    """
+    global _tables
+    tables = {}
+    if enabled:
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        cursor.execute('select tableName, startColumn, endColumn, ' + \
+            'promoterOffset from refSchema;')
+        for table, start, end, offset in cursor.fetchall():
+            tables[table] = (start, end, offset)
+        conn.close()
+    with _lock:
+        _tables = tables
+
+
+def binned(table, start, end):
+    """True when the table's bin column covers [start, end] intervals"""
+    found = _tables.get(table)
+    return (found is not None and found[0] == start and found[1] == end)
+
+
+def promoterBinned(table, offset):
+    """True when the table's promoter columns are widened by offset"""
+    found = _tables.get(table)
+    return (found is not None and found[2] is not None and
+        int(found[2]) == int(offset))
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and not sys.argv[1].isdigit()):
+        print("Usage: python refschema.py [promoter_offset] [table ...]")
+    else:
+        offset = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+        migrate(sys.argv[2:] or None, offset)
+
+### EOF
@@ -12,6 +12,8 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import time
 import driver
+import s3stream
+import file_utils as fu
 import boto3
 import os
 import glob
@@ -43,10 +45,9 @@ class Timer(object):
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
 
-def upload_file(directory, file, user):
-    """Uploads a specified file with key to S3"""
+def object_key(directory, file, user):
+    """Creates the S3 object name of a job's file"""
 
-    # Create the object name for the file
     delim = '~'
     try:
         uuid = directory.split('/')[-1]
@@ -55,15 +56,23 @@ def upload_file(directory, file, user):
         return
 
     key = uuid + delim + os.path.basename(file)
+    return f'{config["aws"]["S3KeyPrefix"]}/{user}/{key}'
+
+
+def upload_file(directory, file, user):
+    """Uploads a specified file with key to S3"""
+
+    # Create the object name for the file
+    obj_name = object_key(directory, file, user)
+    if obj_name is None:
+        return
 
     bucket = config['aws']['S3ResultsBucket']
-    obj_name = f'{config["aws"]["S3KeyPrefix"]}/{user}/{key}'
 
+    # Shared client and multipart settings, see s3stream.py
     # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
     try:
-        with open(file, "rb") as f:
-            s3 = boto3.client("s3", region_name=config['aws']['RegionName'])
-            s3.upload_fileobj(f, bucket, obj_name)
+        s3stream.logTransfer(directory, s3stream.upload(file, bucket, obj_name))
         return obj_name     # Return the key to be sent to the database
     except (ClientError, IOError) as e:
         print(e)
@@ -73,7 +82,8 @@ def upload_file(directory, file, user):
 def upload_results(directory, user):
     """
         Utility function to format the data to send to upload_file.
-        Appends the uuid to the file.annot.vcf path with a delimiting character
+        Appends the uuid to the file.annot.vcf (or file.annot.vcf.gz, see
+        CompressOutput) path with a delimiting character
     """
 
     # Get the results file
@@ -87,6 +97,18 @@ def upload_results(directory, user):
     return upload_file(directory, results_file, user)
 
 
+def log_transfers(directory):
+    """Appends the throughput of the job's S3 transfers to its log file"""
+
+    transfers = os.path.join(directory, s3stream.TRANSFER_LOG)
+    try:
+        log_file = glob.glob(directory+config['file']['LogExtension'])[0]
+        with open(transfers) as f, open(log_file, 'a') as log:
+            log.write(f.read())
+    except (IndexError, IOError) as e:
+        print(e)
+
+
 def upload_log(directory, user):
     """
         Utility function to format the data to send to upload_file.
@@ -104,6 +126,36 @@ def upload_log(directory, user):
     return upload_file(directory, results_file, user)
 
 
+def stream_results(path, user, bucket, key):
+    """
+        Streaming mode: annotates the input object bucket/key as it is
+        downloaded and uploads the results by multipart upload as they are
+        produced (see s3stream.py); only the log file is written to the
+        job directory. Returns the results key
+    """
+
+    directory = os.path.dirname(path)
+    obj_name = object_key(directory, driver.resultName(path), user)
+    if obj_name is None:
+        return
+
+    try:
+        start = time.time()
+        s3 = s3stream.client()
+        body = s3.get_object(Bucket=bucket, Key=key)['Body']
+        with s3stream.MultipartWriter(s3, config['aws']['S3ResultsBucket'],
+                                      obj_name) as upload:
+            fh_out = fu.BgzfWriter(upload) if driver.COMPRESS_OUTPUT else upload
+            driver.run(path, 'vcf', stream=(s3stream.lines(body), fh_out))
+            fh_out.close()
+        s3stream.logTransfer(directory, s3stream.report(
+            'streamed upload', obj_name, upload.size, time.time() - start))
+        return obj_name
+    except ClientError as e:
+        print(e)
+        return
+
+
 def split_path(path):
     """Extracts the directory path and filename from the path"""
 
@@ -116,21 +168,33 @@ def split_path(path):
 if __name__ == '__main__':
     # Call the AnnTools pipeline
     if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-
-        # Get the job_id, user_id, and completion times
+        # Get the job_id and user_id
         job_id = sys.argv[2]
         user_id = sys.argv[3]
+
+        # Streaming mode: the input S3 bucket and key follow the user_id
+        # Rerun by hand on the same host, the job resumes from its
+        # checkpoint (see Checkpoint); nothing reruns it by itself
+        streamed = len(sys.argv) > 5
+        with Timer():
+            if streamed:
+                results_key = stream_results(sys.argv[1], user_id,
+                                             sys.argv[4], sys.argv[5])
+            else:
+                driver.run(sys.argv[1], 'vcf', job_id=job_id)
+
+        # Get the completion time
         complete_time = int(time.time())
 
         # Get the unique_id and filename
         folder, filename = split_path(sys.argv[1])
 
-        # 1. Upload the results file
-        results_key = upload_results(folder, user_id)
+        # 1. Upload the results file (already uploaded when streamed)
+        if not streamed:
+            results_key = upload_results(folder, user_id)
 
-        # 2. Upload the log file
+        # 2. Upload the log file, with the transfer throughput
+        log_transfers(folder)
         log_key = upload_log(folder, user_id)
 
         # Update the database with the relevant information
@@ -188,6 +252,6 @@ if __name__ == '__main__':
                   f"{e.response['Error']['Message']}")
 
     else:
-        print("A valid .vcf file must be provided as input to this program.")
+        print("A valid .vcf or .vcf.gz file must be provided as input to this program.")
 
 # EOF
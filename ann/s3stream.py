@@ -0,0 +1,208 @@
+# s3stream.py
+#
+# S3 transfers of the annotation jobs
+#
+# download() and upload() move job files with one S3 client shared by the
+# process and multipart transfers of S3ChunkSize MB parts, up to
+# S3MaxConcurrency at once (see ann_config.ini); each returns a
+# throughput line, which logTransfer() keeps for the job log.
+# For streamed jobs, lines() reads an S3 object body as VCF lines while
+# it downloads, decompressing gzip and bgzip bodies on the fly, so the
+# fused pipeline starts on the first chunk. MultipartWriter uploads what
+# the pipeline writes in parts as they fill up, so neither the input nor
+# the results are staged on local disk.
+#
+##
+
+import os
+import time
+import zlib
+import itertools
+import threading
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.client import Config
+from configparser import ConfigParser
+
+# Initialize Config Parser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 
+    'ann_config.ini'))
+
+MB = 1 << 20
+
+# Bytes per multipart part, uploaded or downloaded; S3 requires at least
+# 5MB for all but the last part
+PART_SIZE = max(config.getint('aws', 'S3ChunkSize', fallback=64), 5) * MB
+
+# Parts transferred at once per file
+MAX_CONCURRENCY = config.getint('aws', 'S3MaxConcurrency', fallback=10)
+
+# Bytes read from an object body at a time
+CHUNK_SIZE = 1 << 20
+
+# Job file collecting the throughput lines of its transfers
+TRANSFER_LOG = 'transfer.log'
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Client shared by the transfers of this process, see client()
+_client = None
+_lock = threading.Lock()
+
+
+def client():
+    """S3 client of this process, created on first use with a connection
+       pool large enough for MAX_CONCURRENCY parts at once
+    """
+    global _client
+    with _lock:
+        if _client is None:
+            _client = boto3.client('s3', 
+                region_name=config.get('aws', 'RegionName'),
+                config=Config(max_pool_connections=max(MAX_CONCURRENCY, 10)))
+    return _client
+
+
+def transferConfig():
+    """Multipart settings of download() and upload()"""
+    return TransferConfig(multipart_threshold=PART_SIZE,
+        multipart_chunksize=PART_SIZE, max_concurrency=MAX_CONCURRENCY,
+        use_threads=(MAX_CONCURRENCY > 1))
+
+
+def report(action, key, size, seconds):
+    """Throughput line of a transfer of size bytes"""
+    rate = (size / MB) / seconds if (seconds > 0) else 0.0
+    return f"S3 {action} {key}: {size / MB:.1f} MB in {seconds:.2f}s " + \
+        f"({rate:.1f} MB/s)\n"
+
+
+def download(bucket, key, path):
+    """Downloads S3 object bucket/key to path; returns the throughput line"""
+    start = time.time()
+    client().download_file(bucket, key, path, Config=transferConfig())
+    return report('download', key, os.path.getsize(path), time.time() - start)
+
+
+def upload(path, bucket, key):
+    """Uploads path to S3 object bucket/key; returns the throughput line"""
+    start = time.time()
+    client().upload_file(path, bucket, key, Config=transferConfig())
+    return report('upload', key, os.path.getsize(path), time.time() - start)
+
+
+def logTransfer(directory, line):
+    """Adds a throughput line to the job directory's TRANSFER_LOG"""
+    print(line, end='')
+    with open(os.path.join(directory, TRANSFER_LOG), 'a') as fh:
+        fh.write(line)
+
+
+def lines(body, chunk_size=CHUNK_SIZE):
+    """Text lines of an S3 object body (a botocore StreamingBody), with
+       their newlines as when iterating over a file
+    """
+    chunks = body.iter_chunks(chunk_size)
+    first = next(chunks, b'')
+    chunks = itertools.chain([first], chunks)
+    if first.startswith(GZIP_MAGIC):
+        chunks = gunzip(chunks)
+
+    pending = b''
+    for chunk in chunks:
+        parts = (pending + chunk).split(b'\n')
+        pending = parts.pop()
+        for part in parts:
+            yield part.decode() + '\n'
+    if (pending != b''):
+        yield pending.decode()
+
+
+def gunzip(chunks):
+    """Decompressed data of gzip chunks; every member of a multi-member
+       (bgzip) stream is decompressed in turn
+    """
+    inflate = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        while (len(chunk) > 0):
+            if inflate.eof:
+                inflate = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            yield inflate.decompress(chunk)
+            chunk = inflate.unused_data if inflate.eof else b''
+
+
+class MultipartWriter(object):
+    """File-like writer uploading to an S3 object by multipart upload.
+
+    Text is encoded as UTF-8. Parts are uploaded as soon as part_size
+    bytes are buffered; close() uploads the rest and completes the upload,
+    which is aborted instead when the writer is left by an exception.
+    Output smaller than one part is uploaded with a single put_object.
+    size counts the bytes written.
+    """
+    def __init__(self, s3, bucket, key, part_size=PART_SIZE):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer.extend(data)
+        self.size = self.size + len(data)
+        while (len(self.buffer) >= self.part_size):
+            self.upload(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def upload(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+            PartNumber=number, UploadId=self.upload_id, Body=data)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key,
+                Body=bytes(self.buffer))
+        else:
+            if (len(self.buffer) > 0):
+                self.upload(bytes(self.buffer))
+            self.s3.complete_multipart_upload(Bucket=self.bucket,
+                Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+
+    def abort(self):
+        """Drops the upload; parts already sent are deleted by S3"""
+        self.closed = True
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        else:
+            self.abort()
+
+### EOF
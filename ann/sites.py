@@ -0,0 +1,180 @@
+# sites.py
+#
+# Per-site memoization of reference lookups, shared by all stages
+#
+# Multi-sample and trio VCFs repeat the same site many times; every
+# stage looks a site up through lookup(), which answers repeats from a
+# bounded LRU instead of the reference database. With a host store (see
+# sitestore.py) lookups are also kept across jobs.
+#
+##
+
+import threading
+from collections import OrderedDict
+
+# Lookups kept per process (0 disables the cache)
+CACHE_SIZE = 0
+
+_cache = OrderedDict()
+hits = 0
+misses = 0
+
+# Persistent host-wide store behind the in-memory cache, see useStore()
+_store = None
+
+# Guards the cache, its counters and the store for concurrent stages
+_lock = threading.Lock()
+
+
+def setCacheSize(size):
+    """Number of lookups kept per process; 0 disables the cache"""
+    global CACHE_SIZE
+    CACHE_SIZE = size
+    while (len(_cache) > CACHE_SIZE):
+        _cache.popitem(last=False)
+
+
+def useStore(store):
+    """Looks up misses of the in-memory cache in a sitestore.SiteStore
+       (None for no store) and stores what is fetched
+    """
+    global _store
+    _store = store
+
+
+def _remember(key, result):
+    _cache[key] = result
+    if (len(_cache) > CACHE_SIZE):
+        _cache.popitem(last=False)
+
+
+def lookup(name, site, fetch):
+    """Result of fetch() for a site of the named lookup, memoized.
+       site must hold everything the result depends on (normalized
+       chromosome, position, alleles, ...); results are shared, so callers
+       must not modify them.
+    """
+    global hits, misses
+    if (CACHE_SIZE <= 0 and _store is None):
+        return fetch()
+
+    key = (name, site)
+    with _lock:
+        if key in _cache:
+            hits = hits + 1
+            _cache.move_to_end(key)
+            return _cache[key]
+
+        misses = misses + 1
+        found = False
+        if (_store is not None):
+            found, result = _store.get(name, site)
+
+    if not found:
+        result = fetch()
+    with _lock:
+        if (not found and _store is not None):
+            _store.put(name, site, result)
+        if (CACHE_SIZE > 0):
+            _remember(key, result)
+    return result
+
+
+def lookupMany(name, sites, fetch):
+    """Results of fetch() for a batch of sites, one per site, memoized;
+       fetch is called once with the list of distinct sites not cached
+       and returns one result per site
+    """
+    global hits, misses
+    if (CACHE_SIZE <= 0 and _store is None):
+        return fetch(sites)
+
+    results = {}
+    missing = []
+    with _lock:
+        for site in sites:
+            key = (name, site)
+            if key in _cache:
+                hits = hits + 1
+                _cache.move_to_end(key)
+                results[site] = _cache[key]
+            else:
+                misses = misses + 1
+                if site not in results:
+                    results[site] = None
+                    missing.append(site)
+
+        if (_store is not None):
+            stored = []
+            for site in missing:
+                found, result = _store.get(name, site)
+                if found:
+                    results[site] = result
+                    stored.append(site)
+            missing = [site for site in missing if site not in stored]
+            if (CACHE_SIZE > 0):
+                for site in stored:
+                    _remember((name, site), results[site])
+
+    if (len(missing) > 0):
+        fetched = fetch(missing)
+        with _lock:
+            for site, result in zip(missing, fetched):
+                results[site] = result
+                if (_store is not None):
+                    _store.put(name, site, result)
+                if (CACHE_SIZE > 0):
+                    _remember((name, site), result)
+
+    return [results[site] for site in sites]
+
+
+def flush():
+    """Writes pending lookups to the host store, if there is one"""
+    if (_store is not None):
+        _store.flush()
+
+
+def reset():
+    """Zeroes the hit and miss counters; cached lookups are kept"""
+    global hits, misses
+    hits = 0
+    misses = 0
+    if (_store is not None):
+        _store.hits = 0
+        _store.misses = 0
+
+
+def counters():
+    """Hit and miss counts of the cache and of the host store"""
+    if (_store is None):
+        return [hits, misses, 0, 0]
+    return [hits, misses, _store.hits, _store.misses]
+
+
+def addCounters(counts):
+    """Adds counters() of an earlier run, e.g. of the stages a resumed
+       job completed before
+    """
+    global hits, misses
+    with _lock:
+        hits = hits + counts[0]
+        misses = misses + counts[1]
+        if (_store is not None):
+            _store.hits = _store.hits + counts[2]
+            _store.misses = _store.misses + counts[3]
+
+
+def report():
+    """.count.log lines with the hit and miss counts of the cache and the
+       host store, for those in use
+    """
+    lines = []
+    if (CACHE_SIZE > 0):
+        lines.append(f"Site cache: {str(hits)} hits {str(misses)} misses\n")
+    if (_store is not None):
+        lines.append(f"Host cache: {str(_store.hits)} hits " + \
+            f"{str(_store.misses)} misses\n")
+    return lines
+
+### EOF
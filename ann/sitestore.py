@@ -0,0 +1,106 @@
+# sitestore.py
+#
+# Persistent, host-wide store of per-site reference lookups
+#
+# A SQLite file shared by every annotation job on the host; entries are
+# keyed by reference version and site, so repeat sites across jobs skip
+# the reference lookups entirely. The least recently used entries are
+# evicted once the store holds more than its size.
+#
+##
+
+import os
+import time
+import pickle
+import sqlite3
+
+# Entries written between commits
+COMMIT_EVERY = 1000
+
+
+class SiteStore(object):
+    """On-disk lookup results of one reference version.
+
+    Used entries are touched and evictions run in flush(), at the end of
+    a job, so a lookup costs a single indexed read. Every process opens
+    its own connection; concurrent jobs share the file through SQLite's
+    write-ahead log.
+    """
+    def __init__(self, path, version, size):
+        self.path = path
+        self.version = version
+        self.size = size
+        self.conn = None
+        self.pid = None
+        self.used = []
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if (self.conn is None or self.pid != os.getpid()):
+            directory = os.path.dirname(self.path)
+            if (directory != ''):
+                os.makedirs(directory, exist_ok=True)
+            # Threads of one process share the connection, see sites._lock
+            self.conn = sqlite3.connect(self.path, timeout=60, 
+                check_same_thread=False)
+            self.conn.execute('pragma journal_mode=wal;')
+            self.conn.execute('create table if not exists sites ' + \
+                '(key text primary key, value blob, used real);')
+            self.conn.execute('create index if not exists sites_used ' + \
+                'on sites (used);')
+            self.pid = os.getpid()
+            self.used = []
+            self.pending = 0
+        return self.conn
+
+    def key(self, name, site):
+        return repr((self.version, name, site))
+
+    def get(self, name, site):
+        """(True, result) for a stored lookup, (False, None) otherwise"""
+        key = self.key(name, site)
+        row = self._connect().execute(
+            'select value from sites where key = ?;', (key,)).fetchone()
+        if (row is None):
+            self.misses = self.misses + 1
+            return (False, None)
+
+        self.hits = self.hits + 1
+        self.used.append(key)
+        return (True, pickle.loads(row[0]))
+
+    def put(self, name, site, result):
+        conn = self._connect()
+        conn.execute('insert or replace into sites values (?, ?, ?);',
+            (self.key(name, site), pickle.dumps(result), time.time()))
+        self.pending = self.pending + 1
+        if (self.pending >= COMMIT_EVERY):
+            conn.commit()
+            self.pending = 0
+
+    def flush(self):
+        """Commits new entries, touches used ones and evicts the least
+           recently used entries beyond the store size
+        """
+        if (self.conn is None or self.pid != os.getpid()):
+            return
+
+        now = time.time()
+        self.conn.executemany('update sites set used = ? where key = ?;',
+            [(now, key) for key in self.used])
+        self.used = []
+        count = self.conn.execute('select count(*) from sites;').fetchone()[0]
+        if (count > self.size):
+            self.conn.execute('delete from sites where key in (select key ' + \
+                'from sites order by used limit ?);', (count - self.size,))
+        self.conn.commit()
+        self.pending = 0
+
+    def hitRate(self):
+        """Share of lookups answered by the store, in percent"""
+        total = self.hits + self.misses
+        return (self.hits / float(total)) * 100 if (total > 0) else 0.0
+
+### EOF
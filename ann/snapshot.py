@@ -0,0 +1,399 @@
+# snapshot.py
+#
+# Local, memory-mapped snapshot of the AnnTools reference database
+#
+# Build:  python snapshot.py <snapshot_dir> [version]
+#
+# Every table is exported per chromosome into fixed-width NumPy arrays
+# (interval start/end, row ordinal, the intervals laid out as a nested
+# containment list and one array per integer column, NULL stored as
+# INT_NULL) plus a byte heap with offsets for every other column. Rows are streamed from the database and spooled
+# to disk, so the build needs memory for a few arrays of the largest
+# chromosome, not its rows.
+# Readers memory-map the files, so all annotator processes on a host
+# share one page-cached copy and no stage needs the network.
+#
+##
+
+import os
+import sys
+import json
+import time
+import mmap
+import shutil
+import numpy as np
+import pymysql
+import utils as u
+import intervals
+
+# Reference tables: (chromosome column, interval start, interval end).
+# Point tables use the same column for start and end.
+TABLES = {
+    'dbSNP': ('CHR', 'POS', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start', 'start'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+}
+for c in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13',
+    '14', '15', '16', '17', '18', '19', '20', '21', '22', 'X', 'Y']:
+    TABLES['tfbsConsSites' + c] = ('chrom', 'chromStart', 'chromEnd')
+
+MANIFEST = 'manifest.json'
+
+
+# Rows fetched from the database at a time while building
+FETCH_SIZE = 100000
+
+# Rows gathered at a time by SnapshotIndex.scan()
+SCAN_SIZE = 4096
+
+# Stored in place of NULL in 'int' columns
+INT_NULL = int(np.iinfo(np.int64).min)
+
+
+def isInt(v):
+    """True for a value an 'int' column stores (None as INT_NULL)"""
+    return (v is None or (isinstance(v, int) and not isinstance(v, bool) and
+        INT_NULL < v <= np.iinfo(np.int64).max))
+
+
+class ColumnSpool(object):
+    """One column of a chromosome spooled to temporary files in fetch
+    order, so that no chromosome is held in memory.
+
+    The column is stored as 'int' (int64 values, INT_NULL for NULL) until
+    a value that is not an integer comes, then as 'str' or, once a bytes
+    value comes, 'bytes': the encoded values are appended to a heap and
+    their lengths (-1 for NULL) to the values file.
+    """
+    def __init__(self, path, c):
+        self.path = path
+        self.c = c
+        self.kind = 'int'
+        self.values = open(self.tmp('values'), 'wb')
+        self.heap = None
+
+    def extend(self, values):
+        if (self.kind == 'int'):
+            if all(isInt(v) for v in values):
+                np.array([INT_NULL if v is None else v for v in values],
+                    dtype=np.int64).tofile(self.values)
+                return
+            self.toText()
+
+        if (self.kind == 'str' and
+            any(isinstance(v, (bytes, bytearray)) for v in values)):
+            self.kind = 'bytes'
+        lengths = []
+        for v in values:
+            if v is None:
+                lengths.append(-1)
+                continue
+            if isinstance(v, (bytes, bytearray)):
+                data = bytes(v)
+            else:
+                data = str(v).encode('utf-8')
+            self.heap.write(data)
+            lengths.append(len(data))
+        np.array(lengths, dtype=np.int64).tofile(self.values)
+
+    def tmp(self, name):
+        return os.path.join(self.path, f"c{self.c}.{name}.tmp")
+
+    def toText(self):
+        """Rewrites the integers spooled so far as text"""
+        self.values.close()
+        ints = np.fromfile(self.tmp('values'), dtype=np.int64)
+        self.values = open(self.tmp('values'), 'wb')
+        self.heap = open(self.tmp('heap'), 'wb')
+        self.kind = 'str'
+        self.extend([None if (v == INT_NULL) else int(v) for v in ints])
+
+    def write(self, order):
+        """Writes the column in the given row order as c<c>.npy (int) or
+           c<c>.heap and c<c>.offsets.npy; NULL is b'' in a 'bytes' column
+           and 'None' in a 'str' one
+        """
+        self.values.close()
+        values = np.fromfile(self.tmp('values'), dtype=np.int64)
+        if (self.kind == 'int'):
+            np.save(os.path.join(self.path, f"c{self.c}.npy"), values[order])
+        else:
+            self.heap.close()
+            null = b'' if (self.kind == 'bytes') else b'None'
+            starts = np.concatenate(([0], np.cumsum(np.maximum(values, 0))))
+            heap = b''
+            if (os.path.getsize(self.tmp('heap')) > 0):
+                heap = np.memmap(self.tmp('heap'), dtype=np.uint8,
+                    mode='r')
+            offsets = np.zeros(len(order) + 1, dtype=np.int64)
+            with open(os.path.join(self.path, f"c{self.c}.heap"), 'wb') as out:
+                for n, i in enumerate(order):
+                    if (values[i] < 0):
+                        data = null
+                    else:
+                        data = bytes(heap[starts[i]:starts[i + 1]])
+                    out.write(data)
+                    offsets[n + 1] = offsets[n] + len(data)
+            np.save(os.path.join(self.path, f"c{self.c}.offsets.npy"), offsets)
+            del heap
+            os.unlink(self.tmp('heap'))
+        os.unlink(self.tmp('values'))
+        return self.kind
+
+
+def writeChrom(path, batches, columns, start, end):
+    """Writes the rows of one chromosome, fetched in batches, sorted by
+       interval start; returns (row count, column kinds, top level size
+       of the nested containment list)
+    """
+    os.makedirs(path, exist_ok=True)
+    spools = [ColumnSpool(path, c) for c in range(len(columns))]
+    bounds = open(os.path.join(path, 'bounds.tmp'), 'wb')
+    for rows in batches:
+        np.array([(int(r[start]), int(r[end])) for r in rows],
+            dtype=np.int64).tofile(bounds)
+        for c, spool in enumerate(spools):
+            spool.extend([r[c] for r in rows])
+    bounds.close()
+
+    bounds = np.fromfile(os.path.join(path, 'bounds.tmp'), 
+        dtype=np.int64).reshape(-1, 2)
+    os.unlink(os.path.join(path, 'bounds.tmp'))
+    # Stable, so rows with the same start keep their table order
+    order = np.argsort(bounds[:, 0], kind='stable')
+    nested = intervals.NestedList.build(bounds[order, 0], bounds[order, 1],
+        order)
+    np.save(os.path.join(path, 'start.npy'), bounds[order, 0])
+    np.save(os.path.join(path, 'end.npy'), bounds[order, 1])
+    np.save(os.path.join(path, 'ordinal.npy'), order.astype(np.int64))
+    np.save(os.path.join(path, 'nested.npy'), np.stack((nested.starts,
+        nested.ends, nested.index, nested.sublo, nested.subhi)))
+
+    kinds = [spool.write(order) for spool in spools]
+    return (len(order), kinds, nested.top)
+
+
+def fetchBatches(cursor):
+    """Rows of the executed query of an unbuffered cursor, FETCH_SIZE at
+       a time
+    """
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if (len(rows) == 0):
+            return
+        yield rows
+
+
+def build(root, version=None, tables=None):
+    """Exports the reference tables into root/<version>/, returns its path"""
+    if version is None:
+        version = time.strftime('%Y%m%d%H%M%S')
+    if tables is None:
+        tables = sorted(TABLES)
+
+    path = os.path.join(root, version)
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        raise ValueError(f"Snapshot version {version} already exists")
+    shutil.rmtree(path, ignore_errors=True)
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    manifest = {'version': version, 'created': int(time.time()), 'tables': {}}
+
+    for table in tables:
+        chrom, start, end = TABLES[table]
+        cursor.execute('select distinct ' + chrom + ' from ' + table + ';')
+        chroms = sorted([str(r[0]) for r in cursor.fetchall()])
+        # Read apart from the rows, so empty tables keep their columns
+        cursor.execute('select * from ' + table + ' limit 0;')
+        meta = {'chrom': chrom, 'start': start, 'end': end, 'chroms': {},
+            'columns': [d[0] for d in cursor.description]}
+
+        for i, name in enumerate(chroms):
+            # Streamed, a chromosome of dbSNP does not fit in memory
+            stream = conn.cursor(pymysql.cursors.SSCursor)
+            stream.execute('select * from ' + table + ' where ' + chrom + \
+                '=%s;', (name,))
+            # Chromosomes are stored under numbered directories
+            rows, kinds, top = writeChrom(os.path.join(path, table, str(i)),
+                fetchBatches(stream), meta['columns'],
+                meta['columns'].index(start), meta['columns'].index(end))
+            stream.close()
+            meta['chroms'][name] = {'dir': str(i), 'rows': rows,
+                'kinds': kinds, 'top': top}
+
+        manifest['tables'][table] = meta
+        print(f"{table} - {len(chroms)} chromosomes exported.")
+
+    conn.close()
+
+    # The manifest is written last, so readers never see a partial snapshot
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    return path
+
+
+def versions(root):
+    """Complete snapshot versions under root, oldest first"""
+    if not os.path.isdir(root):
+        return []
+    return sorted([v for v in os.listdir(root)
+        if os.path.isfile(os.path.join(root, v, MANIFEST))])
+
+
+class Snapshot(object):
+    """Read-only, memory-mapped view of one snapshot version"""
+    def __init__(self, root, version=None):
+        if version is None:
+            found = versions(root)
+            if (len(found) == 0):
+                raise ValueError(f"No reference snapshot found in {root}")
+            version = found[-1]
+
+        self.path = os.path.join(root, version)
+        self.version = version
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self._indexes = {}
+
+    def index(self, table, chrom=None, start=None, end=None):
+        """SnapshotIndex for a table; the requested interval columns must
+           match the ones the snapshot was built with
+        """
+        if table not in self.manifest['tables']:
+            raise ValueError(f"Table {table} is not in snapshot {self.version}")
+
+        meta = self.manifest['tables'][table]
+        for name, value in (('chrom', chrom), ('start', start), ('end', end)):
+            if (value is not None and value != meta[name]):
+                raise ValueError(f"Snapshot {self.version} indexes {table} " + \
+                    f"on {meta['chrom']}:{meta['start']}-{meta['end']}")
+
+        if table not in self._indexes:
+            self._indexes[table] = SnapshotIndex(
+                os.path.join(self.path, table), meta)
+        return self._indexes[table]
+
+
+class SnapshotIndex(object):
+    """Interval index over one memory-mapped snapshot table.
+
+    Same query interface as intervals.IntervalIndex; rows are rebuilt as
+    tuples in the table's column order, like a 'select *' row.
+    """
+    def __init__(self, path, meta):
+        self.path = path
+        self.columns = meta['columns']
+        self.meta = meta
+        self._chroms = {}
+
+    def _load(self, chrom):
+        if chrom not in self._chroms:
+            meta = self.meta['chroms'][chrom]
+            path = os.path.join(self.path, meta['dir'])
+            arrays = {}
+            for name in ('start', 'end', 'ordinal', 'nested'):
+                arrays[name] = np.load(os.path.join(path, name + '.npy'),
+                    mmap_mode='r')
+            arrays['nested'] = intervals.NestedList(arrays['nested'],
+                meta['top'], arrays['ordinal'])
+
+            cols = []
+            for c, kind in enumerate(meta['kinds']):
+                if (kind == 'int'):
+                    cols.append((kind, np.load(os.path.join(path, f"c{c}.npy"),
+                        mmap_mode='r'), None))
+                    continue
+                heapfile = os.path.join(path, f"c{c}.heap")
+                heap = b''
+                if (os.path.getsize(heapfile) > 0):
+                    # Slices of an mmap are bytes, without a NumPy view each
+                    with open(heapfile, 'rb') as f:
+                        heap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                cols.append((kind, heap, np.load(
+                    os.path.join(path, f"c{c}.offsets.npy"), mmap_mode='r')))
+            arrays['columns'] = cols
+            self._chroms[chrom] = arrays
+
+        return self._chroms[chrom]
+
+    def rows(self, chrom, hits):
+        """Rows at the start-order indices hits of a chromosome; every
+           column is gathered with one fancy-indexing read
+        """
+        if (len(hits) == 0):
+            return []
+
+        hits = np.asarray(hits, dtype=np.int64)
+        columns = []
+        for kind, data, offsets in self._load(chrom)['columns']:
+            if (kind == 'int'):
+                values = data[hits].tolist()
+                if INT_NULL in values:
+                    values = [None if (v == INT_NULL) else v for v in values]
+                columns.append(values)
+                continue
+            values = [data[a:b] for a, b in zip(offsets[hits].tolist(),
+                offsets[hits + 1].tolist())]
+            if (kind == 'str'):
+                values = [v.decode('utf-8') for v in values]
+            columns.append(values)
+        return list(zip(*columns))
+
+    def overlap(self, chrom, start, end):
+        """Rows whose interval overlaps [start, end], in table order"""
+        if chrom not in self.meta['chroms']:
+            return []
+
+        return self.rows(chrom, self._load(chrom)['nested'].overlap(start, end))
+
+    def stab(self, chrom, pos):
+        """Rows whose interval contains pos, in table order"""
+        return self.overlap(chrom, pos, pos)
+
+    def stabMany(self, chrom, positions):
+        """stab() of every position of a NumPy array, vectorized"""
+        if chrom not in self.meta['chroms']:
+            return [[] for p in positions]
+
+        found = self._load(chrom)['nested'].stabMany(positions)
+        # One gather for the hits of all positions, split back after
+        rows = iter(self.rows(chrom, [i for hits in found for i in hits]))
+        return [[next(rows) for i in hits] for hits in found]
+
+    def scan(self, chrom):
+        """(start, end, ordinal, row) for every row of a chromosome, in
+           start order; used as the reference stream of intervals.SweepIndex
+        """
+        if chrom not in self.meta['chroms']:
+            return
+
+        c = self._load(chrom)
+        for a in range(0, len(c['start']), SCAN_SIZE):
+            b = min(a + SCAN_SIZE, len(c['start']))
+            yield from zip(c['start'][a:b].tolist(), c['end'][a:b].tolist(),
+                c['ordinal'][a:b].tolist(), self.rows(chrom, range(a, b)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        version = sys.argv[2] if len(sys.argv) > 2 else None
+        print(f"Snapshot written to {build(sys.argv[1], version)}")
+    else:
+        print("Usage: python snapshot.py <snapshot_dir> [version]")
+
+### EOF
@@ -0,0 +1,83 @@
+# transcripts.py
+#
+# Parsed transcript models of refGene rows (exon boundaries), cached
+# across variants so each transcript's exonStarts/exonEnds blobs are
+# decoded and split once
+#
+##
+
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Transcript models kept per process, least recently used evicted first
+CACHE_SIZE = 10000
+
+_models = OrderedDict()
+_lock = threading.Lock()
+
+
+class TranscriptModel(object):
+    """Exon boundaries of one transcript as integer arrays.
+
+    Exons of a refGene transcript are sorted and do not overlap, so the
+    exons containing a position are found by bisecting the starts and
+    walking back while the ends still reach it. Rows whose exons are not
+    in that order are answered by a linear scan.
+    """
+    def __init__(self, exonStarts, exonEnds, exonCount):
+        if isinstance(exonStarts, (bytes, bytearray)):
+            exonStarts = exonStarts.decode('utf-8')
+        if isinstance(exonEnds, (bytes, bytearray)):
+            exonEnds = exonEnds.decode('utf-8')
+        starts = str(exonStarts).split(',')
+        ends = str(exonEnds).split(',')
+
+        self.count = int(exonCount)
+        self.starts = array('q', [int(starts[e]) for e in range(self.count)])
+        self.ends = array('q', [int(ends[e]) for e in range(self.count)])
+        self.ordered = all([self.starts[e - 1] <= self.starts[e] and
+            self.ends[e - 1] <= self.ends[e] for e in range(1, self.count)])
+
+    def exons(self, pos):
+        """Indices of the exons containing pos (bounds included), ascending"""
+        if not self.ordered:
+            return [e for e in range(self.count)
+                if (self.starts[e] <= pos and pos <= self.ends[e])]
+
+        found = []
+        e = bisect_right(self.starts, pos) - 1
+        while (e >= 0 and self.ends[e] >= pos):
+            found.append(e)
+            e = e - 1
+        found.reverse()
+        return found
+
+
+def setCacheSize(size):
+    """Number of transcript models kept per process"""
+    global CACHE_SIZE
+    CACHE_SIZE = size
+    while (len(_models) > CACHE_SIZE):
+        _models.popitem(last=False)
+
+
+def model(row):
+    """TranscriptModel of a refGene row, parsed on first use"""
+    # A transcript is identified by its name and location
+    key = (row[1], row[2], row[4], row[5])
+    with _lock:
+        if key in _models:
+            _models.move_to_end(key)
+            return _models[key]
+
+    m = TranscriptModel(row[9], row[10], row[8])
+    if (CACHE_SIZE > 0):
+        with _lock:
+            _models[key] = m
+            if (len(_models) > CACHE_SIZE):
+                _models.popitem(last=False)
+    return m
+
+### EOF
@@ -13,13 +13,37 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
+from configparser import ConfigParser
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# Initialize Config Parser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 
+    'ann_config.ini'))
+
+# Seconds the RDS secret is reused before it is fetched again
+SECRET_TTL = config.getint('db', 'SecretTTL', fallback=3600)
+# Idle connections kept per process
+POOL_SIZE = config.getint('db', 'PoolSize', fallback=16)
+# Idle seconds after which a pooled connection is pinged before reuse
+HEALTH_CHECK_IDLE = config.getint('db', 'HealthCheckIdle', fallback=30)
+
+_secret = None
+_secret_time = 0
+
+
+"""RDS credentials from AWS Secrets Manager, cached for SECRET_TTL seconds
 """
-def db_connect():
+def getRdsSecret(refresh=False):
+    global _secret, _secret_time
+    if (not refresh and _secret is not None and 
+        time.time() - _secret_time < SECRET_TTL):
+        return _secret
+
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
@@ -27,25 +51,173 @@ def db_connect():
     asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
         asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
+        _secret = json.loads(asm_response['SecretString'])
+        _secret_time = time.time()
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
+    return _secret
+
+
+"""Opens a new connection to the reference database; the secret is
+   fetched again once if the cached credentials are rejected
+"""
+def db_open():
     database_name = 'annotator'
 
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+    for refresh in (False, True):
+        rds_secret = getRdsSecret(refresh=refresh)
+        try:
+            return pymysql.connect(
+                host=rds_secret['host'],
+                port=rds_secret['port'],
+                user=rds_secret['username'],
+                passwd=rds_secret['password'],
+                db=database_name)
+        except pymysql.err.OperationalError as e:
+            # 1045: access denied, the secret may have been rotated
+            if (refresh or e.args[0] != 1045):
+                raise e
+
+
+# MySQL client errors of a connection dropped by the server: 2006 server
+# gone away, 2013 connection lost during a query
+CONNECTION_LOST = (2006, 2013)
+
+
+class PooledConnection(object):
+    """Connection borrowed from a ConnectionPool; close() returns it to
+    the pool instead of closing it. Its cursors replace the connection
+    when the server drops it during a query (see PooledCursor).
+    Everything else is the pymysql connection.
+    """
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args):
+        return PooledCursor(self, args)
+
+    def replace(self, conn):
+        """Swaps in a new connection for one the server dropped"""
+        if (self._conn is not conn):
+            return
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+        self._conn = db_open()
+
+    def close(self):
+        if (self._conn is not None):
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+class PooledCursor(object):
+    """Cursor of a PooledConnection. A query failing because the server
+    dropped the connection is retried once on a new connection; the
+    cursor then reads the retried query's results. Everything else is the
+    pymysql cursor.
+    """
+    def __init__(self, pooled, args):
+        self._pooled = pooled
+        self._args = args
+        self._conn = pooled._conn
+        self._cursor = self._conn.cursor(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, args=None):
+        # Another cursor may have replaced the connection already
+        if (self._conn is not self._pooled._conn):
+            self._reopen()
+        try:
+            return self._cursor.execute(query, args)
+        except pymysql.err.OperationalError as e:
+            if (e.args[0] not in CONNECTION_LOST):
+                raise e
+        self._pooled.replace(self._conn)
+        self._reopen()
+        return self._cursor.execute(query, args)
+
+    def _reopen(self):
+        self._conn = self._pooled._conn
+        self._cursor = self._conn.cursor(*self._args)
+
+
+class ConnectionPool(object):
+    """Process-wide pool of reference database connections.
+
+    Idle connections are pinged (and reconnected) before reuse once they
+    have been idle for HEALTH_CHECK_IDLE seconds; a connection that cannot
+    be revived is replaced by a new one. At most size idle connections are
+    kept. A forked child never reuses its parent's connections.
+    """
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = []
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def _take(self):
+        with self.lock:
+            if (self.pid != os.getpid()):
+                self.idle = []
+                self.pid = os.getpid()
+            if (len(self.idle) > 0):
+                return self.idle.pop()
+        return None
+
+    def borrow(self):
+        entry = self._take()
+        while (entry is not None):
+            conn, released = entry
+            if (time.time() - released < HEALTH_CHECK_IDLE):
+                return PooledConnection(self, conn)
+            try:
+                conn.ping(reconnect=True)
+                return PooledConnection(self, conn)
+            except pymysql.err.Error:
+                try:
+                    conn.close()
+                except pymysql.err.Error:
+                    pass
+            entry = self._take()
+
+        return PooledConnection(self, db_open())
+
+    def release(self, conn):
+        with self.lock:
+            if (self.pid == os.getpid() and len(self.idle) < self.size):
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn, released in idle:
+            conn.close()
+
+
+pool = ConnectionPool()
+
+
+"""Get connection to reference database, borrowed from the process-wide
+   pool; close() returns it to the pool
+"""
+def db_connect():
+    return pool.borrow()
 
 
 """Column inices for pileup and VCF
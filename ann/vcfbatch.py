@@ -0,0 +1,76 @@
+# vcfbatch.py
+#
+# Columnar batches of VCF records for the overlap stages
+#
+# batches() cuts a stream of VCF lines into blocks of records and lays
+# the sites of each block out as NumPy columns: chromosome codes,
+# positions and REF/ALT as categorical codes. Overlap stages look a whole
+# chromosome of a block up at once against the reference interval arrays
+# (see intervals.NestedList) instead of one record at a time.
+#
+##
+
+import numpy as np
+import vcfrecord
+
+
+class Batch(object):
+    """A block of vcfrecord.Records and the columns of their sites.
+
+    chroms, refs and alts are codes into chromNames, refNames and
+    altNames; positions are int64.
+    """
+    __slots__ = ('records', 'chroms', 'chromNames', 'positions', 'refs',
+        'refNames', 'alts', 'altNames')
+
+    def __init__(self, records, inds):
+        self.records = records
+        columns = [[rec.fields[i].strip() for rec in records] for i in inds]
+        self.chromNames, self.chroms = categories(columns[0])
+        self.positions = np.array([int(p) for p in columns[1]],
+            dtype=np.int64)
+        self.refNames, self.refs = categories(columns[2])
+        self.altNames, self.alts = categories(columns[3])
+
+    def __len__(self):
+        return len(self.records)
+
+    def groups(self):
+        """(chromosome, record indices) for every chromosome of the batch"""
+        order = np.argsort(self.chroms, kind='stable')
+        bounds = np.searchsorted(self.chroms[order],
+            np.arange(len(self.chromNames) + 1))
+        for code, name in enumerate(self.chromNames):
+            yield (name, order[bounds[code]:bounds[code + 1]])
+
+
+def categories(values):
+    """(distinct values, int32 code of every value)"""
+    names, codes = np.unique(np.array(values, dtype=object),
+        return_inverse=True)
+    return (list(names), codes.astype(np.int32))
+
+
+def batches(lines, inds, sep='\t', size=1000):
+    """Header lines (stripped) and Batches of up to size data records, in
+       input order; inds are the CHROM, POS, REF and ALT columns
+    """
+    records = []
+    for line in lines:
+        rec = vcfrecord.parse(line, sep)
+        if rec is not None:
+            records.append(rec)
+            if (len(records) >= size):
+                yield Batch(records, inds)
+                records = []
+            continue
+
+        if (len(records) > 0):
+            yield Batch(records, inds)
+            records = []
+        yield line.strip()
+
+    if (len(records) > 0):
+        yield Batch(records, inds)
+
+### EOF
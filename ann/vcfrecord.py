@@ -0,0 +1,148 @@
+# vcfrecord.py
+#
+# VCF records passed between the annotation stages
+#
+# A data line is split into a Record once, by the first stage it enters;
+# later stages read its columns and add to its INFO builder, and the
+# record is serialized once, when it is written out. Header lines stay
+# strings.
+# Only the columns up to INFO are split; FORMAT and the sample columns,
+# which no stage reads, are carried as one untouched string, so wide
+# multi-sample records cost about as much as single-sample ones.
+#
+##
+
+# Columns before INFO: CHROM, POS, ID, REF, ALT, QUAL, FILTER
+INFO = 7
+
+
+class Info(object):
+    """INFO column built by appending.
+
+    Additions are kept as pieces and joined only when the column is read
+    as a whole, so annotating a heavily annotated record costs the size
+    of the addition, not of the column. Entries are looked up by key in
+    a dict built on the first lookup after a change.
+    """
+    __slots__ = ('parts', 'last', 'entries')
+
+    def __init__(self, text):
+        self.parts = [text]
+        self.last = text[-1:]
+        self.entries = None
+
+    def __str__(self):
+        if (len(self.parts) > 1):
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+    def append(self, text):
+        """Appends text as is"""
+        if (text != ''):
+            self.parts.append(text)
+            self.last = text[-1]
+            self.entries = None
+
+    def add(self, entry):
+        """Appends an entry, separated by ';' unless INFO ends with one"""
+        if (self.last == ';'):
+            self.append(entry)
+        else:
+            self.append(';' + entry)
+
+    def set(self, text):
+        """Replaces the whole column"""
+        self.parts = [text]
+        self.last = text[-1:]
+        self.entries = None
+
+    def get(self, key):
+        """Value of the first entry named key, '.' when there is none"""
+        if (self.entries is None):
+            self.entries = {}
+            for entry in str(self).strip().split(';'):
+                pair = entry.split('=')
+                if (len(pair) > 1):
+                    self.entries.setdefault(pair[0].strip(), pair[1])
+        return self.entries.get(key, '.')
+
+    def pad(self):
+        self.parts.insert(0, ' ')
+        if (self.last == ''):
+            self.last = ' '
+
+    def rstrip(self):
+        """Removes trailing whitespace"""
+        while (self.last.isspace()):
+            text = self.parts.pop().rstrip()
+            if (text != '' or len(self.parts) == 0):
+                self.parts.append(text)
+            self.last = self.parts[-1][-1:]
+            self.entries = None
+
+
+class Record(object):
+    """One VCF data line: the columns up to INFO, with INFO as an Info
+    builder, and the rest of the line (FORMAT and samples) as it was read
+    """
+    __slots__ = ('fields', 'tail', 'pads', 'sep')
+
+    def __init__(self, line, sep='\t'):
+        self.fields = line.split(sep, INFO + 1)
+        self.tail = None
+        if (len(self.fields) > INFO + 1):
+            self.tail = self.fields.pop()
+        if (len(self.fields) > INFO):
+            self.fields[INFO] = Info(self.fields[INFO])
+        self.pads = 0
+        self.sep = sep
+
+    @property
+    def info(self):
+        return self.fields[INFO]
+
+    def __str__(self):
+        line = self.sep.join([str(f) for f in self.fields])
+        if (self.tail is None):
+            return line
+
+        # Padding of the tail columns is applied only here
+        tail = self.tail
+        if (self.pads > 0):
+            pad = ' ' * self.pads
+            tail = pad + tail.replace(self.sep, self.sep + pad)
+        return line + self.sep + tail
+
+    def pad(self):
+        """Prefixes every column but the first with a space, as joining
+           the columns with sep + ' ' does
+        """
+        for i in range(1, len(self.fields)):
+            if (i == INFO):
+                self.fields[i].pad()
+            else:
+                self.fields[i] = ' ' + self.fields[i]
+        self.pads = self.pads + 1
+
+    def strip(self):
+        """Removes trailing whitespace of the line, as stripping the
+           serialized line would
+        """
+        if (self.tail is None and len(self.fields) == INFO + 1):
+            self.fields[INFO].rstrip()
+
+
+def parse(line, sep='\t'):
+    """Record of a data line, None for a header line; Records are
+       passed through
+    """
+    if isinstance(line, Record):
+        line.strip()
+        return line
+
+    line = line.strip()
+    if (line.startswith('#') or line.startswith('CHROM')):
+        return None
+    return Record(line, sep)
+
+### EOF